@@ -0,0 +1,81 @@
+"""Admission control for the public webhooks, applied before any config lookup.
+
+Each request to a guarded route spends one token from two buckets: one for its
+From number on that route, and one shared by the whole route. A sender's bucket
+holds ONCALL_ADMIT_SENDER_BURST tokens and refills at ONCALL_ADMIT_SENDER_RATE per
+second; a route's, ONCALL_ADMIT_ROUTE_BURST and ONCALL_ADMIT_ROUTE_RATE. A rate of 0
+turns that kind of limit off. The sender's bucket is checked first, so a number
+that is already being shed does not use up the route's allowance. Routes that only
+team members can use to any effect (the SMS commands) can be left out of the route
+limit, so a flood from strangers cannot crowd the members out.
+
+Senders the caller vouches for as team members (those with a live SMS session) draw
+from buckets of their own instead, ONCALL_ADMIT_MEMBER_BURST tokens refilled at
+ONCALL_ADMIT_MEMBER_RATE per second, and never from the route's.
+
+Buckets live in each worker process. Sender and member buckets are kept in LRUs bounded
+by ONCALL_ADMIT_MAX_SENDERS; a sender evicted from one starts again with a full bucket.
+"""
+from collections import OrderedDict
+import os
+import threading
+import time
+
+SENDER_RATE = float(os.getenv('ONCALL_ADMIT_SENDER_RATE', '0.2'))
+SENDER_BURST = float(os.getenv('ONCALL_ADMIT_SENDER_BURST', '5'))
+ROUTE_RATE = float(os.getenv('ONCALL_ADMIT_ROUTE_RATE', '20'))
+ROUTE_BURST = float(os.getenv('ONCALL_ADMIT_ROUTE_BURST', '40'))
+MEMBER_RATE = float(os.getenv('ONCALL_ADMIT_MEMBER_RATE', '1'))
+MEMBER_BURST = float(os.getenv('ONCALL_ADMIT_MEMBER_BURST', '20'))
+MAX_SENDERS = int(os.getenv('ONCALL_ADMIT_MAX_SENDERS', '10000'))
+
+class _TokenBucket(object):
+    __slots__ = ('tokens', 'updated_at')
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated_at = now
+
+    def take(self, rate, burst, now):
+        self.tokens = min(burst, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+_lock = threading.Lock()
+# (route, From) -> _TokenBucket, least recently used first
+_sender_buckets = OrderedDict()
+_member_buckets = OrderedDict()
+_route_buckets = dict()
+
+def admit(route, sender, member=False, route_limited=True):
+    """None if the request may proceed, else why it is shed: 'member', 'sender' or 'route'.
+    member says the sender is a known team member; route_limited, whether the route's shared
+    bucket applies to everybody else."""
+    now = time.monotonic()
+    with _lock:
+        if member:
+            if MEMBER_RATE > 0 and not _take_sender(_member_buckets, (route, sender), MEMBER_RATE, MEMBER_BURST, now):
+                return 'member'
+            return None
+        if SENDER_RATE > 0 and not _take_sender(_sender_buckets, (route, sender), SENDER_RATE, SENDER_BURST, now):
+            return 'sender'
+        if route_limited and ROUTE_RATE > 0:
+            bucket = _route_buckets.get(route)
+            if bucket is None:
+                bucket = _route_buckets[route] = _TokenBucket(ROUTE_BURST, now)
+            if not bucket.take(ROUTE_RATE, ROUTE_BURST, now):
+                return 'route'
+    return None
+
+def _take_sender(buckets, key, rate, burst, now):
+    bucket = buckets.get(key)
+    if bucket is None:
+        bucket = buckets[key] = _TokenBucket(burst, now)
+        if len(buckets) > MAX_SENDERS:
+            buckets.popitem(last=False)
+    else:
+        buckets.move_to_end(key)
+    return bucket.take(rate, burst, now)
@@ -0,0 +1,255 @@
+"""Searchable index of the S3 archive: recordings and config changes.
+
+Every recording saved to S3 and every config write gets a small JSON object in the
+index, under a prefix for its kind and UTC day:
+
+    manifest/[<team>/]recordings/2026-10-17/143005_<CallSid>.json
+    manifest/[<team>/]config/2026-10-17/143005_<digest>.json
+
+Entries are journaled in the outbox and written from there, so the request that
+produced them does not wait on S3 and a failed write is retried. Each entry has a
+key of its own, derived from its contents, so writers never contend with each other
+and a retried write that had in fact succeeded is recognised (If-None-Match) and
+left alone. A recording's entry is also stored as manifest/[<team>/]calls/<CallSid>.json.
+
+Once a UTC day is over (plus ONCALL_ARCHIVE_COMPACT_DELAY seconds for stragglers), its
+entries are compacted into one segment of JSON lines beside the day's prefix:
+
+    manifest/[<team>/]recordings/2026-10-17.jsonl
+
+An entry that arrives after its day was compacted has the segment rebuilt. A query
+reads one segment per closed day in its range, and lists and reads the entries of
+a day only while it has no segment (today, usually); a call SID is one object.
+
+Run "python archive.py --help" to query from the command line.
+"""
+import argparse
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+import clients
+import config_store
+import metrics
+import outbox
+
+# How long after the end of a UTC day its entries are compacted into the day's segment
+COMPACT_DELAY = float(os.getenv('ONCALL_ARCHIVE_COMPACT_DELAY', '3600'))
+
+class ManifestAppendError(Exception):
+    """An index entry could not be written to the archive bucket"""
+
+def archive_bucket():
+    return os.getenv('ONCALL_ARCHIVE_BUCKET') or os.getenv('BACKING_STORE_S3_BUCKET')
+
+def record_recording(team, entry):
+    """Queue a saved recording for the index; entry needs at least time, call_sid, caller_num and key"""
+    _enqueue('recording_index', team, entry)
+
+def record_config_change(team, entry):
+    """Queue a config change (time, actor_id, version, changed sections) for the audit trail"""
+    _enqueue('config_audit', team, entry)
+
+def _enqueue(kind, team, entry):
+    if not archive_bucket():
+        logging.debug('No archive bucket configured, %s entry not indexed', kind)
+        return
+    outbox.enqueue(kind, {'team': team, 'entry': entry})
+
+def _append_recording(payload, attachment_path):
+    """Outbox handler for 'recording_index' deliveries"""
+    team, entry = payload['team'], payload['entry']
+    _put_entry(_entry_key(team, 'recordings', entry, entry['call_sid']), entry)
+    _put_entry(_call_key(team, entry['call_sid']), entry)
+    _schedule_compaction(team, 'recordings', entry)
+    return None
+
+def _append_config_change(payload, attachment_path):
+    """Outbox handler for 'config_audit' deliveries"""
+    team, entry = payload['team'], payload['entry']
+    digest = hashlib.sha1(json.dumps(entry, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    _put_entry(_entry_key(team, 'config', entry, digest), entry)
+    _schedule_compaction(team, 'config', entry)
+    return None
+
+# (team, kind, day) whose compaction this process has already queued
+_compactions_queued = set()
+
+def _schedule_compaction(team, kind, entry):
+    """Queue the compaction of the entry's day, once per process, for when the day is over. A day
+    already due for compaction is compacted (again) now, as its segment may predate this entry."""
+    day = datetime.fromtimestamp(entry['time'], timezone.utc).date()
+    due = datetime.combine(day + timedelta(days=1), datetime.min.time(), timezone.utc).timestamp() + COMPACT_DELAY
+    job = (team, kind, day.strftime('%Y-%m-%d'))
+    if time.time() < due:
+        if job in _compactions_queued:
+            return
+        _compactions_queued.add(job)
+    outbox.enqueue('manifest_compact', {'team': team, 'kind': kind, 'day': job[2]}, not_before=due)
+
+def _compact_day(payload, attachment_path):
+    """Outbox handler for 'manifest_compact' deliveries: gather a day's entries into its segment"""
+    from botocore.exceptions import ClientError
+    team, kind, day = payload['team'], payload['kind'], payload['day']
+    lines = set(json.dumps(entry, sort_keys=True) for entry in _read_entries(team, kind, day))
+    key = _segment_key(team, kind, day)
+    s3c = clients.get_s3_client()
+    try:
+        with metrics.timed('s3.put_manifest'):
+            s3c.put_object(Bucket=archive_bucket(), Key=key, Body=_segment_body(lines), IfNoneMatch='*')
+        return None
+    except ClientError as e:
+        if not config_store.is_write_conflict(e):
+            raise ManifestAppendError('Could not write index segment {}: {}'.format(key, e)) from e
+    # Compacted before, perhaps by another worker from a different listing: keep what either saw,
+    # and write only over the version just read
+    with metrics.timed('s3.get_manifest'):
+        current = s3c.get_object(Bucket=archive_bucket(), Key=key)
+    current_lines = set(current['Body'].read().decode('utf-8').splitlines())
+    if lines <= current_lines:
+        return None
+    try:
+        with metrics.timed('s3.put_manifest'):
+            s3c.put_object(Bucket=archive_bucket(), Key=key, Body=_segment_body(lines | current_lines), IfMatch=current['ETag'])
+    except ClientError as e:
+        raise ManifestAppendError('Could not rewrite index segment {}: {}'.format(key, e)) from e
+    logging.info('Rebuilt index segment %s with %d entries', key, len(lines | current_lines))
+    return None
+
+def _segment_body(lines):
+    """JSON lines in time order"""
+    return ''.join(line + '\n' for line in sorted(lines, key=lambda line: (json.loads(line)['time'], line))).encode('utf-8')
+
+outbox.register_handler('recording_index', _append_recording, lane='index')
+outbox.register_handler('config_audit', _append_config_change, lane='index')
+outbox.register_handler('manifest_compact', _compact_day, lane='index')
+
+def find_recordings(team, since=None, until=None, caller=None, call_sid=None):
+    """Recordings whose time is in [since, until) (epoch seconds; default the last 7 days), optionally
+    only those from caller (any phone number format) or with the given call SID"""
+    if call_sid is not None:
+        entries = [entry for entry in [_get_json(_call_key(team, call_sid))] if entry is not None]
+    else:
+        entries = _read_days(team, 'recordings', _days(since, until))
+    caller_digits = _digits(caller) if caller is not None else None
+    matches = []
+    for entry in entries:
+        if caller_digits is not None and not _digits(entry.get('caller_num', '')).endswith(caller_digits[-10:]):
+            continue
+        if _in_range(entry, since, until):
+            matches.append(entry)
+    return matches
+
+def find_config_changes(team, since=None, until=None, actor_id=None):
+    """Config changes in [since, until) (default the last 7 days), optionally only those made by actor_id"""
+    return [entry for entry in _read_days(team, 'config', _days(since, until))
+            if _in_range(entry, since, until) and (actor_id is None or entry.get('actor_id') == actor_id)]
+
+def _put_entry(key, entry):
+    from botocore.exceptions import ClientError
+    body = json.dumps(entry, sort_keys=True).encode('utf-8')
+    try:
+        with metrics.timed('s3.put_manifest'):
+            clients.get_s3_client().put_object(Bucket=archive_bucket(), Key=key, Body=body, IfNoneMatch='*')
+    except ClientError as e:
+        if config_store.is_write_conflict(e):
+            # Already there: an earlier attempt wrote it before failing to report back
+            return
+        raise ManifestAppendError('Could not write index entry {}: {}'.format(key, e)) from e
+
+def _get_json(key):
+    """The object's JSON, or None if there is none"""
+    body = _get_body(key)
+    return json.loads(body) if body is not None else None
+
+def _get_body(key):
+    from botocore.exceptions import ClientError
+    with metrics.timed('s3.get_manifest'):
+        try:
+            obj = clients.get_s3_client().get_object(Bucket=archive_bucket(), Key=key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+        return obj['Body'].read()
+
+def _read_days(team, kind, days):
+    for day in days:
+        segment = _get_body(_segment_key(team, kind, day))
+        if segment is not None:
+            for line in segment.decode('utf-8').splitlines():
+                yield json.loads(line)
+        else:
+            yield from _read_entries(team, kind, day)
+
+def _read_entries(team, kind, day):
+    """The day's entries, read one object at a time"""
+    paginator = clients.get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=archive_bucket(), Prefix='{}{}/{}/'.format(_prefix(team), kind, day)):
+        for obj in page.get('Contents', []):
+            entry = _get_json(obj['Key'])
+            if entry is not None:
+                yield entry
+
+def _prefix(team):
+    return 'manifest/' + (team + '/' if team else '')
+
+def _entry_key(team, kind, entry, suffix):
+    instant = datetime.fromtimestamp(entry['time'], timezone.utc)
+    return '{}{}/{}/{}_{}.json'.format(_prefix(team), kind, instant.strftime('%Y-%m-%d'), instant.strftime('%H%M%S'), suffix)
+
+def _segment_key(team, kind, day):
+    return '{}{}/{}.jsonl'.format(_prefix(team), kind, day)
+
+def _call_key(team, call_sid):
+    return '{}calls/{}.json'.format(_prefix(team), call_sid)
+
+def _days(since, until):
+    until = time.time() if until is None else until
+    since = until - 7 * 86400 if since is None else since
+    day = datetime.fromtimestamp(since, timezone.utc).date()
+    last = datetime.fromtimestamp(until, timezone.utc).date()
+    days = []
+    while day <= last:
+        days.append(day.strftime('%Y-%m-%d'))
+        day += timedelta(days=1)
+    return days
+
+def _in_range(entry, since, until):
+    return (since is None or entry['time'] >= since) and (until is None or entry['time'] < until)
+
+def _digits(phonenum):
+    return ''.join(c for c in phonenum if c.isdigit())
+
+def _parse_time(value):
+    """Epoch seconds from YYYY-mm-dd, YYYY-mm-ddTHH:MM[:SS] (local time) or a plain number"""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Query the recordings and config-change index of the on-call archive.')
+    parser.add_argument('kind', choices=('recordings', 'config'))
+    parser.add_argument('--team', default='', help='team id, when the app serves several teams')
+    parser.add_argument('--since', type=_parse_time, help='start of the time range (default 7 days before --until)')
+    parser.add_argument('--until', type=_parse_time, help='end of the time range (default now)')
+    parser.add_argument('--caller', help='recordings: only calls from this number')
+    parser.add_argument('--call-sid', help='recordings: only the call with this SID')
+    parser.add_argument('--actor', help='config: only changes made by this user id')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.kind == 'recordings':
+        entries = find_recordings(args.team, args.since, args.until, caller=args.caller, call_sid=args.call_sid)
+    else:
+        entries = find_config_changes(args.team, args.since, args.until, actor_id=args.actor)
+    for entry in entries:
+        sys.stdout.write(json.dumps(entry, sort_keys=True) + '\n')
+
+if __name__ == '__main__':
+    main()
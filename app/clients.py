@@ -0,0 +1,151 @@
+"""Long-lived, per-process clients for S3, the Twilio REST API, SMTP and recording downloads.
+
+Everything here is created on first use and dropped in the child after a fork, so
+gunicorn workers never share sockets with the master or with each other. boto3,
+requests and the Twilio REST client are imported on first use too, which keeps
+importing the app cheap.
+"""
+import logging
+import os
+import smtplib
+import threading
+import time
+from flask_mail import BadHeaderError, sanitize_address, sanitize_addresses
+
+HTTP_POOL_SIZE = int(os.getenv('ONCALL_HTTP_POOL_SIZE', '10'))
+HTTP_TIMEOUT = float(os.getenv('ONCALL_HTTP_TIMEOUT', '30'))
+SMTP_TIMEOUT = float(os.getenv('ONCALL_SMTP_TIMEOUT', '30'))
+TWILIO_API_BASE_URL = 'https://api.twilio.com'
+
+_lock = threading.Lock()
+_smtp_lock = threading.Lock()
+_s3_client = None
+_twilio_client = None
+_media_session = None
+_smtp_conn = None
+_smtp_settings = None
+
+def _reset_after_fork():
+    """Forget the parent's clients; their sockets belong to the parent process"""
+    global _lock, _smtp_lock, _s3_client, _twilio_client, _media_session, _smtp_conn, _smtp_settings
+    _lock = threading.Lock()
+    _smtp_lock = threading.Lock()
+    _s3_client = None
+    _twilio_client = None
+    _media_session = None
+    _smtp_conn = None
+    _smtp_settings = None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def get_s3_client():
+    global _s3_client
+    with _lock:
+        if _s3_client is None:
+            import boto3
+            from botocore.config import Config
+            endpoint_url = os.getenv('BACKING_STORE_S3_ENDPOINT_URL')
+            s3_config = Config(max_pool_connections=HTTP_POOL_SIZE, s3={'addressing_style': 'path'} if endpoint_url else {})
+            _s3_client = boto3.session.Session().client('s3', endpoint_url=endpoint_url, config=s3_config)
+        return _s3_client
+
+def get_twilio_client():
+    global _twilio_client
+    with _lock:
+        if _twilio_client is None:
+            from twilio.rest import Client
+            _twilio_client = Client(os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"), http_client=PooledTwilioHttpClient())
+        return _twilio_client
+
+def get_media_session():
+    """Keep-alive HTTP session for fetching recordings from Twilio"""
+    global _media_session
+    with _lock:
+        if _media_session is None:
+            _media_session = _make_session()
+        return _media_session
+
+def fetch_media(url, fileobj, chunk_size):
+    """Stream the body at url into fileobj, chunk_size bytes at a time"""
+    with get_media_session().get(url, stream=True, timeout=HTTP_TIMEOUT) as media_rsp:
+        media_rsp.raise_for_status()
+        for chunk in media_rsp.iter_content(chunk_size):
+            fileobj.write(chunk)
+
+def _make_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+class PooledTwilioHttpClient(object):
+    """Drop-in for TwilioHttpClient that reuses one keep-alive session instead of opening one per request"""
+    def __init__(self):
+        from twilio.http import get_cert_file
+        self.session = _make_session()
+        self.session.verify = get_cert_file()
+        # Lets the REST client be pointed at a stand-in API, as loadgen.py does
+        self.base_url = os.getenv('TWILIO_API_BASE_URL')
+
+    def request(self, method, url, params=None, data=None, headers=None, auth=None, timeout=None,
+                allow_redirects=False):
+        from twilio.http.response import Response
+        if self.base_url and url.startswith(TWILIO_API_BASE_URL):
+            url = self.base_url + url[len(TWILIO_API_BASE_URL):]
+        response = self.session.request(
+            method.upper(),
+            url,
+            params=params,
+            data=data,
+            headers=headers,
+            auth=auth,
+            timeout=timeout or HTTP_TIMEOUT,
+            allow_redirects=allow_redirects,
+        )
+        return Response(int(response.status_code), response.content.decode('utf-8'))
+
+def send_mail(message, mail_settings):
+    """Send a flask_mail Message over the persistent SMTP connection, reconnecting once if it has gone stale.
+
+    Must be called inside an application context, which flask_mail needs to render the message.
+    """
+    if message.has_bad_headers():
+        raise BadHeaderError
+    if message.date is None:
+        message.date = time.time()
+    envelope = (sanitize_address(message.sender), list(sanitize_addresses(message.send_to)), message.as_bytes(), message.mail_options, message.rcpt_options)
+    with _smtp_lock:
+        try:
+            _get_smtp_conn(mail_settings).sendmail(*envelope)
+        except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+            logging.warning('SMTP connection failed (%s), reconnecting', e)
+            _drop_smtp_conn()
+            _get_smtp_conn(mail_settings).sendmail(*envelope)
+
+def _get_smtp_conn(mail_settings):
+    global _smtp_conn, _smtp_settings
+    if _smtp_conn is not None and _smtp_settings != mail_settings:
+        logging.info('Mail settings changed, replacing SMTP connection')
+        _drop_smtp_conn()
+    if _smtp_conn is None:
+        conn = smtplib.SMTP(mail_settings['mail_server'], mail_settings['mail_port'], timeout=SMTP_TIMEOUT)
+        if mail_settings['mail_use_tls']:
+            conn.starttls()
+        if mail_settings['mail_username'] and mail_settings['mail_password']:
+            conn.login(mail_settings['mail_username'], mail_settings['mail_password'])
+        _smtp_conn = conn
+        _smtp_settings = dict(mail_settings)
+    return _smtp_conn
+
+def _drop_smtp_conn():
+    global _smtp_conn, _smtp_settings
+    if _smtp_conn is not None:
+        try:
+            _smtp_conn.quit()
+        except (smtplib.SMTPException, OSError):
+            _smtp_conn.close()
+    _smtp_conn = None
+    _smtp_settings = None
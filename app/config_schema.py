@@ -0,0 +1,244 @@
+"""Validation of the operational config.
+
+The schema below is compiled once, at import, into nested check functions. A given config
+revision is validated only once; the outcome is remembered by content hash, so
+repeated reads of an unchanged config cost a dict lookup. Failures are reported
+as a ConfigValidationError listing every problem found, and do not depend on
+assert statements, so behaviour is the same under python -O.
+"""
+from collections import OrderedDict, namedtuple
+import hashlib
+import re
+import threading
+
+PHONE_RE = re.compile(r"^\+1[2-9][0-9]{2}[2-9][0-9]{6}$")
+EMAIL_RE = re.compile(r"\S+@\S+\.\S+")
+REQUIRED = object()
+NUMBER = (int, float)
+
+ConfigError = namedtuple('ConfigError', ['path', 'message'])
+
+class ConfigValidationError(ValueError):
+    def __init__(self, errors):
+        self.errors = list(errors)
+        super().__init__('Config failed validation: ' + '; '.join('{}: {}'.format(e.path, e.message) for e in self.errors))
+
+class EachValue(object):
+    """Apply a schema to every value of a dict"""
+    def __init__(self, schema):
+        self.schema = schema
+
+class EachItem(object):
+    """Apply a schema to every item of a list"""
+    def __init__(self, schema):
+        self.schema = schema
+
+class Optional(object):
+    """A key that may be absent, but must match schema when present"""
+    def __init__(self, schema):
+        self.schema = schema
+
+USER_SCHEMA = {
+    'id': REQUIRED,
+    'name': REQUIRED,
+    'phone': PHONE_RE,
+}
+
+INTERVAL_SCHEMA = {
+    'start': NUMBER,
+    'end': NUMBER,
+    'user_id': REQUIRED,
+}
+
+SCHEDULE_SCHEMA = {
+    'rotations': Optional(EachItem({
+        'id': REQUIRED,
+        'users': EachItem(REQUIRED),
+        'start': NUMBER,
+        'shift_length': NUMBER,
+    })),
+    'holidays': Optional(EachItem(INTERVAL_SCHEMA)),
+    'overrides': Optional(EachItem(INTERVAL_SCHEMA)),
+}
+
+ESCALATION_SCHEMA = {
+    'tiers': EachItem({
+        'user_ids': EachItem(REQUIRED),
+        'after': NUMBER,
+    }),
+}
+
+CONFIG_SCHEMA = {
+    'current_config': {
+        'oncall_user': USER_SCHEMA,
+        'pager_phone': PHONE_RE,
+        'from_phone': PHONE_RE,
+        'last_modified_time': REQUIRED,
+        'last_modified_user_id': REQUIRED,
+        'session_lifetime': REQUIRED,
+        'mail_settings': {
+            'from_email': EMAIL_RE,
+            'mail_password': REQUIRED,
+            'mail_port': REQUIRED,
+            'mail_server': REQUIRED,
+            'mail_use_tls': REQUIRED,
+            'mail_username': REQUIRED,
+            'to_email': EMAIL_RE,
+        },
+    },
+    'available_users': {
+        'users': EachValue(USER_SCHEMA),
+    },
+    'schedule': Optional(SCHEDULE_SCHEMA),
+    'escalation': Optional(ESCALATION_SCHEMA),
+}
+
+def _join(path, key):
+    return path + '.' + key if path else key
+
+def _compile(schema):
+    """Turn a schema into a check(value, path, errors) callable"""
+    if schema is REQUIRED:
+        return lambda value, path, errors: None
+    if isinstance(schema, re.Pattern):
+        def check_pattern(value, path, errors):
+            if not isinstance(value, str) or not schema.fullmatch(value):
+                errors.append(ConfigError(path, 'value {!r} failed validation'.format(value)))
+        return check_pattern
+    if isinstance(schema, tuple):
+        def check_type(value, path, errors):
+            if isinstance(value, bool) or not isinstance(value, schema):
+                errors.append(ConfigError(path, 'value {!r} is not a number'.format(value)))
+        return check_type
+    if isinstance(schema, EachItem):
+        item_check = _compile(schema.schema)
+        def check_items(value, path, errors):
+            if not isinstance(value, list):
+                errors.append(ConfigError(path, 'not a list'))
+                return
+            for index, item in enumerate(value):
+                item_check(item, '{}[{}]'.format(path, index), errors)
+        return check_items
+    if isinstance(schema, EachValue):
+        item_check = _compile(schema.schema)
+        def check_each(value, path, errors):
+            if not isinstance(value, dict):
+                errors.append(ConfigError(path, 'not an object'))
+                return
+            for key, item in value.items():
+                item_check(item, _join(path, key), errors)
+        return check_each
+    field_checks = [(key, isinstance(sub_schema, Optional), _compile(sub_schema.schema if isinstance(sub_schema, Optional) else sub_schema))
+                    for key, sub_schema in schema.items()]
+    def check_object(value, path, errors):
+        if not isinstance(value, dict):
+            errors.append(ConfigError(path, 'not an object'))
+            return
+        for key, optional, field_check in field_checks:
+            if key not in value:
+                if not optional:
+                    errors.append(ConfigError(_join(path, key), 'not present'))
+            else:
+                field_check(value[key], _join(path, key), errors)
+    return check_object
+
+_check_config = _compile(CONFIG_SCHEMA)
+
+def _check_available_users_unique(config_dict, errors):
+    available_users = config_dict.get('available_users') if isinstance(config_dict, dict) else None
+    users = available_users.get('users') if isinstance(available_users, dict) else None
+    if not isinstance(users, dict):
+        return
+    phone_dedup = set()
+    name_dedup = set()
+    for user_id, user_dict in users.items():
+        if not isinstance(user_dict, dict):
+            continue
+        path = 'available_users.users.' + user_id
+        if user_dict.get('id') != user_id:
+            errors.append(ConfigError(path + '.id', 'mismatched with outer id ' + user_id))
+        if user_dict.get('phone') in phone_dedup:
+            errors.append(ConfigError(path + '.phone', 'phone {} is not unique among available users'.format(user_dict.get('phone'))))
+        phone_dedup.add(user_dict.get('phone'))
+        if user_dict.get('name') in name_dedup:
+            errors.append(ConfigError(path + '.name', 'name {} is not unique among available users'.format(user_dict.get('name'))))
+        name_dedup.add(user_dict.get('name'))
+
+def _as_list(value):
+    return value if isinstance(value, list) else []
+
+def _check_schedule_consistent(config_dict, errors):
+    schedule_dict = config_dict.get('schedule') if isinstance(config_dict, dict) else None
+    if not isinstance(schedule_dict, dict):
+        return
+    available_users = config_dict.get('available_users')
+    users = available_users.get('users') if isinstance(available_users, dict) else None
+    if not isinstance(users, dict):
+        return
+    def check_user(user_id, path):
+        if not isinstance(user_id, str) or user_id not in users:
+            errors.append(ConfigError(path, 'user {!r} is not among available users'.format(user_id)))
+    for index, rotation in enumerate(_as_list(schedule_dict.get('rotations'))):
+        path = 'schedule.rotations[{}]'.format(index)
+        if not isinstance(rotation, dict) or not isinstance(rotation.get('users'), list):
+            continue
+        if not rotation['users']:
+            errors.append(ConfigError(path + '.users', 'no users in rotation'))
+        for user_index, user_id in enumerate(rotation['users']):
+            check_user(user_id, '{}.users[{}]'.format(path, user_index))
+        if isinstance(rotation.get('shift_length'), NUMBER) and rotation['shift_length'] <= 0:
+            errors.append(ConfigError(path + '.shift_length', 'must be positive'))
+    for section in ('holidays', 'overrides'):
+        for index, interval in enumerate(_as_list(schedule_dict.get(section))):
+            path = 'schedule.{}[{}]'.format(section, index)
+            if not isinstance(interval, dict):
+                continue
+            check_user(interval.get('user_id'), path + '.user_id')
+            if isinstance(interval.get('start'), NUMBER) and isinstance(interval.get('end'), NUMBER) and interval['end'] <= interval['start']:
+                errors.append(ConfigError(path, 'ends before it starts'))
+
+def _check_escalation_users(config_dict, errors):
+    escalation = config_dict.get('escalation') if isinstance(config_dict, dict) else None
+    available_users = config_dict.get('available_users') if isinstance(config_dict, dict) else None
+    users = available_users.get('users') if isinstance(available_users, dict) else None
+    if not isinstance(escalation, dict) or not isinstance(users, dict):
+        return
+    for index, tier in enumerate(_as_list(escalation.get('tiers'))):
+        if not isinstance(tier, dict):
+            continue
+        for user_index, user_id in enumerate(_as_list(tier.get('user_ids'))):
+            if not isinstance(user_id, str) or user_id not in users:
+                errors.append(ConfigError('escalation.tiers[{}].user_ids[{}]'.format(index, user_index), 'user {!r} is not among available users'.format(user_id)))
+
+CROSS_CHECKS = [_check_available_users_unique, _check_schedule_consistent, _check_escalation_users]
+
+def validate(config_dict):
+    """Return the list of ConfigErrors for config_dict; empty when it is valid"""
+    errors = []
+    _check_config(config_dict, '', errors)
+    for cross_check in CROSS_CHECKS:
+        cross_check(config_dict, errors)
+    return errors
+
+_RESULT_CACHE_SIZE = 64
+_result_lock = threading.Lock()
+_results = OrderedDict()
+
+def content_hash(raw):
+    return hashlib.sha256(raw).hexdigest()
+
+def check(config_dict, revision):
+    """Raise ConfigValidationError unless config_dict is valid. revision identifies the
+    content (see content_hash) so each revision is only validated once."""
+    with _result_lock:
+        errors = _results.get(revision)
+        if errors is not None:
+            _results.move_to_end(revision)
+    if errors is None:
+        errors = tuple(validate(config_dict))
+        with _result_lock:
+            _results[revision] = errors
+            if len(_results) > _RESULT_CACHE_SIZE:
+                _results.popitem(last=False)
+    if errors:
+        raise ConfigValidationError(errors)
@@ -0,0 +1,198 @@
+"""Storage backends for the operational config.
+
+Every backend stores the raw JSON bytes and hands out an opaque version token
+with them, supporting conditional reads (skip the body if the version is
+unchanged) and conditional writes (refuse if someone else wrote since the
+version that was read). Pick one with BACKING_STORE_BACKEND:
+
+    s3       the object at BACKING_STORE_S3_BUCKET / BACKING_STORE_S3_KEY (default)
+    file     a local file at BACKING_STORE_LOCAL_PATH, read through mmap,
+             polled for changes, replaced atomically on write
+    s3+file  S3, with every version seen written through to the local file so the
+             app can start, and keep serving reads, while S3 is unreachable
+"""
+import fcntl
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+import clients
+
+NOT_MODIFIED = object()
+
+class ConfigWriteConflict(Exception):
+    """The stored config is not at the version the write was based on"""
+
+class S3ConfigStore(object):
+    kind = 's3'
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+
+    def get(self, if_none_match=None):
+        """Return (raw, version), or NOT_MODIFIED if the stored version is if_none_match"""
+        from botocore.exceptions import ClientError
+        get_args = {'Bucket': self.bucket, 'Key': self.key}
+        if if_none_match is not None:
+            get_args['IfNoneMatch'] = if_none_match
+        try:
+            config_obj = clients.get_s3_client().get_object(**get_args)
+        except ClientError as e:
+            if if_none_match is not None and _is_not_modified(e):
+                return NOT_MODIFIED
+            raise
+        return config_obj['Body'].read(), config_obj.get('ETag')
+
+    def put(self, raw, if_match=None):
+        """Store raw and return its version; with if_match, only if the stored version still matches"""
+        from botocore.exceptions import ClientError
+        put_args = {'Bucket': self.bucket, 'Key': self.key, 'Body': raw}
+        if if_match is not None:
+            put_args['IfMatch'] = if_match
+        try:
+            put_rsp = clients.get_s3_client().put_object(**put_args)
+        except ClientError as e:
+            if is_write_conflict(e):
+                raise ConfigWriteConflict(str(e)) from e
+            raise
+        return put_rsp.get('ETag')
+
+    def watch(self, on_change):
+        """S3 offers no change feed; changes are found by revalidating when the cache TTL lapses"""
+
+def _is_not_modified(client_error):
+    status = client_error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    code = client_error.response.get('Error', {}).get('Code')
+    return status == 304 or code in ('304', 'NotModified')
+
+def is_write_conflict(client_error):
+    status = client_error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    code = client_error.response.get('Error', {}).get('Code')
+    return status in (409, 412) or code in ('PreconditionFailed', 'ConditionalRequestConflict')
+
+class LocalFileConfigStore(object):
+    kind = 'file'
+
+    def __init__(self, path, poll_interval=1.0):
+        self.path = os.path.abspath(path)
+        self.poll_interval = poll_interval
+        self._watcher_pid = None
+
+    def get(self, if_none_match=None):
+        if if_none_match is not None and self._version(os.stat(self.path)) == if_none_match:
+            return NOT_MODIFIED
+        with open(self.path, 'rb') as config_file:
+            st = os.fstat(config_file.fileno())
+            if st.st_size == 0:
+                return b'', self._version(st)
+            with mmap.mmap(config_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[:], self._version(st)
+
+    def put(self, raw, if_match=None):
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if if_match is not None:
+                try:
+                    current = self._version(os.stat(self.path))
+                except FileNotFoundError:
+                    current = None
+                if current != if_match:
+                    raise ConfigWriteConflict('{} is at version {}, not {}'.format(self.path, current, if_match))
+            return self._replace(raw)
+
+    def _replace(self, raw):
+        """Write raw beside the config and rename it into place, so readers never see a partial file"""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.' + os.path.basename(self.path) + '.')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(raw)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return self._version(os.stat(self.path))
+
+    def watch(self, on_change):
+        """Poll the file's mtime, size and inode in a daemon thread and call on_change() when they move"""
+        if self._watcher_pid == os.getpid():
+            return
+        self._watcher_pid = os.getpid()
+        threading.Thread(target=self._poll, args=(on_change,), name='config-file-watcher', daemon=True).start()
+
+    def _poll(self, on_change):
+        last_version = None
+        while True:
+            try:
+                version = self._version(os.stat(self.path))
+            except FileNotFoundError:
+                version = None
+            if last_version is not None and version != last_version:
+                logging.info('Config file %s changed (version %s)', self.path, version)
+                on_change()
+            last_version = version
+            time.sleep(self.poll_interval)
+
+    @staticmethod
+    def _version(st):
+        return '{}-{}-{}'.format(st.st_mtime_ns, st.st_size, st.st_ino)
+
+class MirroredS3ConfigStore(object):
+    """S3 as the source of truth, with a local copy refreshed on every new version read or written"""
+    kind = 's3'
+
+    def __init__(self, s3_store, mirror_path):
+        self.s3_store = s3_store
+        self.mirror = LocalFileConfigStore(mirror_path)
+
+    def get(self, if_none_match=None):
+        try:
+            result = self.s3_store.get(if_none_match)
+        except Exception:
+            if if_none_match is not None:
+                # The caller already holds a version that S3 gave out; keep it, with its ETag for later writes
+                logging.warning('S3 unavailable, keeping the config version already loaded', exc_info=True)
+                return NOT_MODIFIED
+            if not os.path.exists(self.mirror.path):
+                raise
+            logging.exception('S3 unavailable, serving config from local mirror %s', self.mirror.path)
+            raw, mirror_version = self.mirror.get()
+            # No S3 version to offer, so the next revalidation fetches the object in full
+            return raw, None
+        if result is not NOT_MODIFIED:
+            self.mirror.put(result[0])
+        return result
+
+    def put(self, raw, if_match=None):
+        if if_match is None:
+            # The caller's copy came from the mirror while S3 was down (or it never read one), so
+            # there is no S3 version to check against; writing would blindly overwrite whatever S3 holds
+            raise ConfigWriteConflict('No S3 version of the config to write against; read it from S3 first')
+        version = self.s3_store.put(raw, if_match)
+        self.mirror.put(raw)
+        return version
+
+    def watch(self, on_change):
+        self.s3_store.watch(on_change)
+
+def from_env(team_id=''):
+    """The store for one team's config; "{team}" in the S3 key or local path is replaced with team_id"""
+    backend = os.getenv('BACKING_STORE_BACKEND', 's3')
+    s3_key = os.getenv('BACKING_STORE_S3_KEY', '').replace('{team}', team_id)
+    local_path = os.getenv('BACKING_STORE_LOCAL_PATH', '').replace('{team}', team_id)
+    settings = {'s3': ['BACKING_STORE_S3_KEY'], 'file': ['BACKING_STORE_LOCAL_PATH'], 's3+file': ['BACKING_STORE_S3_KEY', 'BACKING_STORE_LOCAL_PATH']}.get(backend, [])
+    for name in settings:
+        if team_id and '{team}' not in os.getenv(name, ''):
+            raise ValueError('{} must contain "{{team}}" when ONCALL_TEAMS is set'.format(name))
+    if backend == 's3':
+        return S3ConfigStore(os.getenv('BACKING_STORE_S3_BUCKET'), s3_key)
+    if backend == 'file':
+        return LocalFileConfigStore(local_path, float(os.getenv('BACKING_STORE_POLL_INTERVAL', '1')))
+    if backend == 's3+file':
+        return MirroredS3ConfigStore(S3ConfigStore(os.getenv('BACKING_STORE_S3_BUCKET'), s3_key), local_path)
+    raise ValueError('Unknown BACKING_STORE_BACKEND ' + backend)
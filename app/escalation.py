@@ -0,0 +1,207 @@
+"""Escalation paging: phone the on-call engineer about a voicemail, then further tiers of the
+team on a timer, until somebody acknowledges.
+
+Each tier is journaled in the outbox (kind "page_tier") to become due a set number of
+seconds after the page starts, so pending tiers survive a restart and are run by whichever
+worker claims them. When a tier comes due and the page is still unacknowledged, everyone in
+it is phoned at once from a small thread pool, paced to the Twilio account's calls-per-second
+limit. Acknowledgements (pressing 1 on a page call, or texting ACK) are recorded in a local
+SQLite database shared by the workers on a host; they stop any tiers not yet dialed and hang
+up page calls still ringing. The call pacing is kept in the same database, so the workers on
+a host share one allowance; hosts sharing a Twilio account should split the rate between them.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import contextvars
+import logging
+import os
+import sqlite3
+import threading
+import time
+import clients
+import metrics
+import outbox
+
+ESCALATION_DB = os.getenv('ONCALL_ESCALATION_DB', 'oncall-escalation.sqlite3')
+DIAL_WORKERS = int(os.getenv('ONCALL_ESCALATION_DIAL_WORKERS', '8'))
+# Twilio queues outbound calls beyond the account's CPS limit (1 by default), so pace them here instead;
+# the rate is for all the workers on a host together
+CALLS_PER_SECOND = float(os.getenv('ONCALL_ESCALATION_CALLS_PER_SECOND', '1'))
+RING_TIMEOUT = int(os.getenv('ONCALL_ESCALATION_RING_TIMEOUT', '30'))
+# Pages older than this can no longer be acknowledged by texting ACK
+ACK_WINDOW = float(os.getenv('ONCALL_ESCALATION_ACK_WINDOW', '86400'))
+# Numbers a stopping worker could not dial wait this long, so it does not claim them again on its way out
+SHUTDOWN_REQUEUE_DELAY = 5.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    page_id TEXT PRIMARY KEY,
+    team TEXT NOT NULL,
+    summary TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    acked_at REAL,
+    acked_by TEXT
+);
+CREATE INDEX IF NOT EXISTS pages_open ON pages (team, acked_at, created_at);
+CREATE TABLE IF NOT EXISTS page_calls (
+    page_id TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    call_sid TEXT NOT NULL,
+    PRIMARY KEY (page_id, phone)
+);
+CREATE TABLE IF NOT EXISTS dial_slots (
+    account_sid TEXT PRIMARY KEY,
+    next_slot REAL NOT NULL
+);
+"""
+
+dial_pool = ThreadPoolExecutor(max_workers=DIAL_WORKERS, thread_name_prefix='dialer')
+_init_lock = threading.Lock()
+_initialized_pid = None
+
+def _wait_for_dial_slot():
+    """Sleep until this call's slot, handing out slots CALLS_PER_SECOND apart to every
+    thread of every worker on the host"""
+    if CALLS_PER_SECOND <= 0:
+        return
+    account_sid = os.getenv('TWILIO_ACCOUNT_SID') or ''
+    with _transaction() as conn:
+        row = conn.execute('SELECT next_slot FROM dial_slots WHERE account_sid = ?', (account_sid,)).fetchone()
+        now = time.time()
+        slot = max(now, row[0] if row is not None else 0.0)
+        conn.execute('INSERT OR REPLACE INTO dial_slots (account_sid, next_slot) VALUES (?, ?)', (account_sid, slot + 1.0 / CALLS_PER_SECOND))
+    if slot > now:
+        time.sleep(slot - now)
+
+def start_page(page_id, team, summary, tiers, call_url, from_phone):
+    """Open a page and journal its tiers. tiers is a list of (after_seconds, [phone, ...]);
+    call_url is the TwiML URL Twilio fetches when a page call is answered."""
+    _ensure_initialized()
+    now = time.time()
+    with _transaction() as conn:
+        conn.execute('INSERT OR IGNORE INTO pages (page_id, team, summary, created_at) VALUES (?, ?, ?, ?)', (page_id, team, summary, now))
+    for tier, (after, phones) in enumerate(tiers):
+        outbox.enqueue('page_tier', {'page_id': page_id, 'tier': tier, 'phones': phones, 'url': call_url, 'from_': from_phone}, not_before=now + after)
+    logging.info('Opened page %s for team %r with %d tiers', page_id, team, len(tiers))
+
+def get_page(page_id):
+    """The page's (summary, acked_by), with acked_by None while it is open; None for an unknown page"""
+    _ensure_initialized()
+    rows = _query('SELECT summary, acked_by FROM pages WHERE page_id = ?', (page_id,))
+    return rows[0] if rows else None
+
+def is_acknowledged(page_id):
+    page = get_page(page_id)
+    return page is not None and page[1] is not None
+
+def acknowledge(page_id, acked_by, answering_call_sid=None):
+    """Close the page and hang up its other calls. Returns False if it was already closed."""
+    _ensure_initialized()
+    with _transaction() as conn:
+        cur = conn.execute('UPDATE pages SET acked_at = ?, acked_by = ? WHERE page_id = ? AND acked_at IS NULL', (time.time(), acked_by, page_id))
+        if cur.rowcount == 0:
+            return False
+        call_sids = [row[0] for row in conn.execute('SELECT call_sid FROM page_calls WHERE page_id = ?', (page_id,))]
+    logging.info('Page %s acknowledged by %s', page_id, acked_by)
+    for call_sid in call_sids:
+        if call_sid != answering_call_sid:
+            dial_pool.submit(contextvars.copy_context().run, _hang_up, call_sid)
+    return True
+
+def acknowledge_open_pages(team, acked_by):
+    """Acknowledge every recent open page of the team; returns the ids of those acknowledged"""
+    _ensure_initialized()
+    with _transaction() as conn:
+        page_ids = [row[0] for row in conn.execute('SELECT page_id FROM pages WHERE team = ? AND acked_at IS NULL AND created_at > ?',
+                                                   (team, time.time() - ACK_WINDOW))]
+    return [page_id for page_id in page_ids if acknowledge(page_id, acked_by)]
+
+def _dial_tier(payload, attachment_path):
+    """Outbox handler for 'page_tier' deliveries: hand everyone in the tier to the dialer at once.
+    It does not wait for the calls, so other outbox deliveries are not held up by call pacing."""
+    page_id = payload['page_id']
+    if is_acknowledged(page_id):
+        logging.info('Page %s already acknowledged, skipping tier %d', page_id, payload['tier'])
+        return None
+    dialed = set(row[0] for row in _query('SELECT phone FROM page_calls WHERE page_id = ?', (page_id,)))
+    phones = [phone for phone in payload['phones'] if phone not in dialed]
+    for index, phone in enumerate(phones):
+        try:
+            dial_pool.submit(contextvars.copy_context().run, _dial, payload, phone)
+        except RuntimeError:
+            # The pool is shut down because the process is exiting; the outbox dispatcher may outlive it
+            logging.warning('Page %s tier %d: dialer stopped, leaving %d numbers for later', page_id, payload['tier'], len(phones) - index)
+            outbox.enqueue('page_tier', dict(payload, phones=phones[index:]), not_before=time.time() + SHUTDOWN_REQUEUE_DELAY)
+            return None
+    logging.info('Page %s tier %d: dialing %d numbers', page_id, payload['tier'], len(phones))
+    return None
+
+def _dial(payload, phone):
+    _wait_for_dial_slot()
+    if is_acknowledged(payload['page_id']):
+        return None
+    try:
+        with metrics.timed('twilio.calls.create'):
+            call = clients.get_twilio_client().calls.create(to=phone, from_=payload['from_'], url=payload['url'], timeout=RING_TIMEOUT)
+    except Exception:
+        attempt = payload.get('attempt', 0) + 1
+        if attempt >= outbox.MAX_ATTEMPTS:
+            logging.exception('Page %s: giving up calling %s after %d attempts', payload['page_id'], phone, attempt)
+            return None
+        delay = min(outbox.BACKOFF_CAP, outbox.BACKOFF_BASE * (2 ** (attempt - 1)))
+        logging.exception('Page %s: calling %s failed, retrying in %.0fs', payload['page_id'], phone, delay)
+        outbox.enqueue('page_tier', dict(payload, phones=[phone], attempt=attempt), not_before=time.time() + delay)
+        return None
+    with _transaction() as conn:
+        conn.execute('INSERT OR REPLACE INTO page_calls (page_id, phone, call_sid) VALUES (?, ?, ?)', (payload['page_id'], phone, call.sid))
+    logging.info('Page %s: calling %s, call SID %s', payload['page_id'], phone, call.sid)
+    # An acknowledgement made before the insert above did not know about this call, so hang it up here
+    if is_acknowledged(payload['page_id']):
+        _hang_up(call.sid)
+    return call.sid
+
+def _hang_up(call_sid):
+    try:
+        with metrics.timed('twilio.calls.update'):
+            clients.get_twilio_client().calls(call_sid).update(status='completed')
+    except Exception:
+        # Calls that already ended cannot be updated; nothing else is lost
+        logging.info('Could not hang up page call %s', call_sid, exc_info=True)
+
+outbox.register_handler('page_tier', _dial_tier, lane='page')
+
+def _ensure_initialized():
+    global _initialized_pid
+    with _init_lock:
+        if _initialized_pid == os.getpid():
+            return
+        conn = sqlite3.connect(ESCALATION_DB, timeout=30, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+        _initialized_pid = os.getpid()
+
+def _query(sql, params):
+    """Run one read in autocommit mode: under WAL it neither waits for nor blocks the writers"""
+    conn = sqlite3.connect(ESCALATION_DB, timeout=30, isolation_level=None)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+@contextlib.contextmanager
+def _transaction():
+    """One connection and transaction per operation, as in the outbox"""
+    conn = sqlite3.connect(ESCALATION_DB, timeout=30, isolation_level=None)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
@@ -0,0 +1,40 @@
+"""Gunicorn settings for the on-call app; run-wsgi-app.sh passes this file with -c.
+
+Each worker is a gthread worker serving ONCALL_WORKER_THREADS requests at once. The
+app's outside calls (boto3, requests, the Twilio client, smtplib) and its SQLite
+busy-waits release the GIL while they block, so one slow call does not hold up the
+others. The app is never preloaded in the master, so every worker starts its own
+clients, background threads and SQLite connections after the fork.
+"""
+import multiprocessing
+import os
+import sys
+from dotenv import load_dotenv
+
+# Read app/.env here, in the master, so the settings below and the defaults this file sets honour it
+load_dotenv()
+
+bind = os.getenv('ONCALL_BIND', '127.0.0.1:5000')
+worker_class = 'gthread'
+workers = int(os.getenv('ONCALL_WORKERS', str(min(multiprocessing.cpu_count() * 2 + 1, 8))))
+threads = int(os.getenv('ONCALL_WORKER_THREADS', '16'))
+preload_app = False
+# Twilio gives up on a webhook after 15 seconds; a worker that is stuck much longer than that is restarted
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+# Recycle workers now and then so that slow leaks cannot build up
+max_requests = 10000
+max_requests_jitter = 1000
+
+# Let each worker hold as many S3 and Twilio connections as it has requests in flight
+os.environ.setdefault('ONCALL_HTTP_POOL_SIZE', str(threads))
+# A TAKE and its C can reach different workers, so several workers need the shared session store
+if workers > 1:
+    os.environ.setdefault('ONCALL_SESSION_STORE', 'sqlite')
+
+def worker_exit(server, worker):
+    """Let recordings already handed to the delivery pool finish before the worker goes away"""
+    oncall = sys.modules.get('oncall')
+    if oncall is not None and not oncall.wait_for_deliveries(graceful_timeout):
+        worker.log.warning('Worker exiting with recording deliveries still in progress')
@@ -0,0 +1,531 @@
+"""Webhook replay load generator for the on-call app.
+
+Replays realistic Twilio webhook sequences (voicemails, TAKE/C and WHO text
+exchanges, texts from unknown numbers) at a chosen concurrency and reports
+throughput and latency percentiles per route. S3, the Twilio REST and media
+endpoints, and the SMTP relay are replaced by local stand-ins with adjustable
+latency, so nothing leaves the machine.
+
+Drive the app in this process:
+
+    python loadgen.py run --concurrency 16 --duration 30 --s3-latency 0.05
+
+Or start only the stand-ins, export the variables they print, launch the app
+under gunicorn with those variables set, and drive it over HTTP:
+
+    python loadgen.py fakes --s3-latency 0.05
+    python loadgen.py run --url http://127.0.0.1:5000 --concurrency 16
+"""
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+from xml.sax.saxutils import escape
+import argparse
+import hashlib
+import http.cookiejar
+import json
+import os
+import random
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+BUCKET = 'loadgen-oncall'
+CONFIG_KEY = 'oncall_config.json'
+ACCOUNT_SID = 'AC' + '0' * 32
+PAGER_PHONE = '+18002255288'
+FROM_PHONE = '+19195559876'
+
+class FakeStats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = defaultdict(int)
+
+    def incr(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+STATS = FakeStats()
+
+# ---- S3 stand-in: path-style GET/PUT with ETag preconditions, ListObjectsV2, and multipart uploads ----
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    objects = dict()
+    uploads = dict()
+    lock = threading.Lock()
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _key(self):
+        return urlsplit(self.path).path.lstrip('/')
+
+    def _query(self):
+        return parse_qs(urlsplit(self.path).query, keep_blank_values=True)
+
+    def _reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _error(self, status, code):
+        self._reply(status, '<?xml version="1.0" encoding="UTF-8"?><Error><Code>{}</Code><Message>{}</Message></Error>'.format(code, code).encode(), {'Content-Type': 'application/xml'})
+
+    def _body(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if 'aws-chunked' in self.headers.get('Content-Encoding', ''):
+            body = _decode_aws_chunked(body)
+        return body
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if 'list-type' in self._query():
+            return self._list()
+        STATS.incr('s3 GET')
+        with self.lock:
+            body = self.objects.get(self._key())
+        if body is None:
+            return self._error(404, 'NoSuchKey')
+        etag = _etag(body)
+        if self.headers.get('If-None-Match') == etag:
+            STATS.incr('s3 GET 304')
+            return self._reply(304, headers={'ETag': etag})
+        self._reply(200, body, {'ETag': etag, 'Content-Type': 'application/octet-stream'})
+
+    def _list(self):
+        STATS.incr('s3 LIST')
+        bucket = self._key().rstrip('/')
+        prefix = self._query().get('prefix', [''])[0]
+        with self.lock:
+            keys = sorted(key[len(bucket) + 1:] for key in self.objects if key.startswith(bucket + '/' + prefix))
+        contents = ''.join('<Contents><Key>{}</Key></Contents>'.format(escape(key)) for key in keys)
+        self._reply(200, '<?xml version="1.0" encoding="UTF-8"?><ListBucketResult><Name>{}</Name><Prefix>{}</Prefix><KeyCount>{}</KeyCount><IsTruncated>false</IsTruncated>{}</ListBucketResult>'.format(
+            bucket, escape(prefix), len(keys), contents).encode(), {'Content-Type': 'application/xml'})
+
+    def do_PUT(self):
+        time.sleep(self.latency)
+        key = self._key()
+        query = self._query()
+        body = self._body()
+        if 'uploadId' in query:
+            STATS.incr('s3 UploadPart')
+            with self.lock:
+                self.uploads[query['uploadId'][0]][int(query['partNumber'][0])] = body
+            return self._reply(200, headers={'ETag': _etag(body)})
+        STATS.incr('s3 PUT')
+        with self.lock:
+            current = self.objects.get(key)
+            if_match = self.headers.get('If-Match')
+            if_none_match = self.headers.get('If-None-Match')
+            if (if_match is not None and (current is None or _etag(current) != if_match)) or (if_none_match == '*' and current is not None):
+                STATS.incr('s3 PUT 412')
+                return self._error(412, 'PreconditionFailed')
+            self.objects[key] = body
+        self._reply(200, headers={'ETag': _etag(body)})
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        key = self._key()
+        query = self._query()
+        self._body()
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            with self.lock:
+                self.uploads[upload_id] = dict()
+            return self._reply(200, '<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult><Bucket>{}</Bucket><Key>{}</Key><UploadId>{}</UploadId></InitiateMultipartUploadResult>'.format(BUCKET, key, upload_id).encode(), {'Content-Type': 'application/xml'})
+        STATS.incr('s3 CompleteMultipartUpload')
+        with self.lock:
+            parts = self.uploads.pop(query['uploadId'][0])
+            body = b''.join(parts[n] for n in sorted(parts))
+            self.objects[key] = body
+        self._reply(200, '<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult><Bucket>{}</Bucket><Key>{}</Key><ETag>{}</ETag></CompleteMultipartUploadResult>'.format(BUCKET, key, _etag(body)).encode(), {'Content-Type': 'application/xml'})
+
+    def do_DELETE(self):
+        query = self._query()
+        with self.lock:
+            if 'uploadId' in query:
+                self.uploads.pop(query['uploadId'][0], None)
+            else:
+                self.objects.pop(self._key(), None)
+        self._reply(204)
+
+def _etag(body):
+    return '"{}"'.format(hashlib.md5(body).hexdigest())
+
+def _decode_aws_chunked(body):
+    decoded = bytearray()
+    pos = 0
+    while True:
+        line_end = body.index(b'\r\n', pos)
+        size = int(body[pos:line_end].split(b';')[0], 16)
+        if size == 0:
+            return bytes(decoded)
+        decoded += body[line_end + 2:line_end + 2 + size]
+        pos = line_end + 2 + size + 2
+
+# ---- Twilio stand-in: Messages/Calls REST resources and recording media ----
+
+# The Twilio 6.x client reads every one of these from a created resource
+RESOURCE_FIELDS = ('account_sid', 'annotation', 'answered_by', 'api_version', 'body', 'caller_name', 'date_created',
+                   'date_sent', 'date_updated', 'direction', 'duration', 'end_time', 'error_code', 'error_message',
+                   'forwarded_from', 'from', 'from_formatted', 'group_sid', 'messaging_service_sid', 'num_media',
+                   'num_segments', 'parent_call_sid', 'phone_number_sid', 'price', 'price_unit', 'sid', 'start_time',
+                   'status', 'subresource_uris', 'to', 'to_formatted', 'uri')
+
+class FakeTwilioHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    media_latency = 0.0
+    recording = b''
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.media_latency)
+        STATS.incr('twilio media GET')
+        self._reply(200, self.recording, 'audio/mpeg')
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        path = urlsplit(self.path).path
+        form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+        if path.endswith('/Messages.json'):
+            STATS.incr('twilio messages.create')
+            sid_prefix = 'SM'
+        elif path.endswith('/Calls.json'):
+            STATS.incr('twilio calls.create')
+            sid_prefix = 'CA'
+        elif '/Calls/' in path:
+            STATS.incr('twilio calls.update')
+            resource = dict.fromkeys(RESOURCE_FIELDS)
+            resource.update({'sid': path.rsplit('/', 1)[1][:-len('.json')], 'account_sid': ACCOUNT_SID, 'status': form.get('Status', [''])[0]})
+            return self._reply(200, json.dumps(resource).encode(), 'application/json')
+        else:
+            return self._reply(404, b'{}', 'application/json')
+        resource = dict.fromkeys(RESOURCE_FIELDS)
+        resource.update({'sid': sid_prefix + uuid.uuid4().hex, 'account_sid': ACCOUNT_SID, 'api_version': '2010-04-01', 'status': 'queued',
+                         'to': form.get('To', [''])[0], 'from': form.get('From', [''])[0], 'body': form.get('Body', [''])[0]})
+        self._reply(201, json.dumps(resource).encode(), 'application/json')
+
+# ---- SMTP stand-in: enough of RFC 5321 for smtplib without TLS or AUTH ----
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    latency = 0.0
+
+    def _send(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self._send('220 loadgen ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line.decode('ascii', 'replace').strip().split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                self._send('250-loadgen')
+                self._send('250 8BITMIME')
+            elif verb == 'DATA':
+                self._send('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b'.\n', b''):
+                    pass
+                time.sleep(self.latency)
+                STATS.incr('smtp message')
+                self._send('250 OK queued')
+            elif verb == 'QUIT':
+                self._send('221 Bye')
+                return
+            elif verb in ('HELO', 'MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self._send('250 OK')
+            else:
+                self._send('502 Command not implemented')
+
+class ThreadingSMTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+# ---- Stand-in lifecycle ----
+
+def team_phone(n):
+    return '+1919555{:04d}'.format(1000 + n)
+
+def make_config(team_size, smtp_port, escalation_tiers=0):
+    users = dict()
+    for n in range(team_size):
+        user_id = 'user{}'.format(n)
+        users[user_id] = {'id': user_id, 'name': 'Load User {}'.format(n), 'phone': team_phone(n)}
+    config = {
+        'available_users': {'users': users},
+        'current_config': {
+            'from_phone': FROM_PHONE,
+            'pager_phone': PAGER_PHONE,
+            'last_modified_time': int(time.time()),
+            'last_modified_user_id': 'user0',
+            'oncall_user': users['user0'],
+            'session_lifetime': 300,
+            'mail_settings': {
+                'from_email': 'oncall@loadgen.example.com',
+                'to_email': 'sre@loadgen.example.com',
+                'mail_server': '127.0.0.1',
+                'mail_port': smtp_port,
+                'mail_use_tls': False,
+                'mail_username': '',
+                'mail_password': '',
+            },
+        },
+    }
+    if escalation_tiers > 0:
+        # Everyone but the on-call user, split across the tiers, all due at once so every page dials them
+        others = sorted(users)[1:]
+        config['escalation'] = {'tiers': [{'user_ids': others[tier::escalation_tiers], 'after': 0} for tier in range(escalation_tiers)]}
+    return config
+
+def start_fakes(args):
+    """Start the stand-ins on ephemeral ports and return the environment the app needs to use them"""
+    FakeS3Handler.latency = args.s3_latency
+    FakeTwilioHandler.latency = args.twilio_latency
+    FakeTwilioHandler.media_latency = args.media_latency
+    FakeTwilioHandler.recording = b'ID3' + os.urandom(args.recording_kb * 1024)
+    FakeSMTPHandler.latency = args.smtp_latency
+    s3_server = ThreadingHTTPServer(('127.0.0.1', 0), FakeS3Handler)
+    twilio_server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTwilioHandler)
+    smtp_server = ThreadingSMTPServer(('127.0.0.1', 0), FakeSMTPHandler)
+    for server in (s3_server, twilio_server, smtp_server):
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    config = make_config(args.team_size, smtp_server.server_address[1], args.escalation_tiers)
+    FakeS3Handler.objects['{}/{}'.format(BUCKET, CONFIG_KEY)] = json.dumps(config, sort_keys=True, indent=4).encode()
+    scratch = tempfile.mkdtemp(prefix='oncall-loadgen-')
+    twilio_base = 'http://127.0.0.1:{}'.format(twilio_server.server_address[1])
+    env = {
+        'BACKING_STORE_S3_BUCKET': BUCKET,
+        'BACKING_STORE_S3_KEY': CONFIG_KEY,
+        'BACKING_STORE_S3_ENDPOINT_URL': 'http://127.0.0.1:{}'.format(s3_server.server_address[1]),
+        'AWS_ACCESS_KEY_ID': 'loadgen',
+        'AWS_SECRET_ACCESS_KEY': 'loadgen',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'TWILIO_ACCOUNT_SID': ACCOUNT_SID,
+        'TWILIO_AUTH_TOKEN': 'loadgen',
+        'TWILIO_API_BASE_URL': twilio_base,
+        'LOADGEN_MEDIA_BASE_URL': twilio_base + '/media',
+        'ONCALL_APP_BASE_URL': 'http://127.0.0.1:5000',
+        'ONCALL_OUTBOX_DB': os.path.join(scratch, 'outbox.sqlite3'),
+        'ONCALL_OUTBOX_DIR': os.path.join(scratch, 'outbox'),
+        'ONCALL_ESCALATION_DB': os.path.join(scratch, 'escalation.sqlite3'),
+        'ONCALL_SESSION_DB': os.path.join(scratch, 'sessions.sqlite3'),
+        'ONCALL_SPOOL_DIR': scratch,
+    }
+    if not args.admission:
+        # Generated load comes from a few numbers at a high rate, so it would mostly be shed
+        env.update(ONCALL_ADMIT_SENDER_RATE='0', ONCALL_ADMIT_ROUTE_RATE='0', ONCALL_ADMIT_MEMBER_RATE='0')
+    return env
+
+# ---- Webhook scenarios ----
+
+def voicemail_scenario(rng, ctx):
+    caller = '+1{}{:02d}{}{:06d}'.format(rng.randint(2, 9), rng.randint(0, 99), rng.randint(2, 9), rng.randint(0, 999999))
+    call_sid = 'CA' + uuid.uuid4().hex
+    call = {'From': caller, 'To': PAGER_PHONE, 'CallSid': call_sid, 'FromCity': 'RALEIGH', 'FromState': 'NC', 'CallerName': 'LOAD TEST'}
+    relay = urlencode({'OnmsOrigFrom': caller, 'OnmsOrigFromCity': 'RALEIGH', 'OnmsOrigFromState': 'NC', 'OnmsOrigCallerName': 'LOAD TEST', 'OnmsOrigCallSid': call_sid})
+    recording_url = '{}/RE{}'.format(ctx['media_base_url'], uuid.uuid4().hex)
+    return [
+        ('/public/answer', '', call),
+        ('/public/keypress', '', dict(call, Digits='1')),
+        ('/public/recordingcb', relay, {'RecordingStatus': 'completed', 'RecordingDuration': str(rng.randint(5, 120)), 'RecordingUrl': recording_url, 'CallSid': call_sid}),
+    ]
+
+def take_scenario(rng, ctx):
+    sms = {'From': team_phone(rng.randrange(ctx['team_size'])), 'To': FROM_PHONE}
+    return [
+        ('/msgcontrol/entry', '', dict(sms, Body='TAKE')),
+        ('/msgcontrol/entry', '', dict(sms, Body='C')),
+        ('/msgcontrol/entry', '', dict(sms, Body='WHO')),
+    ]
+
+def who_scenario(rng, ctx):
+    return [('/msgcontrol/entry', '', {'From': team_phone(rng.randrange(ctx['team_size'])), 'To': FROM_PHONE, 'Body': 'WHO'})]
+
+def spam_scenario(rng, ctx):
+    spammer = '+1{}{:02d}{}{:06d}'.format(rng.randint(2, 9), rng.randint(0, 99), rng.randint(2, 9), rng.randint(0, 999999))
+    return [
+        ('/msgcontrol/entry', '', {'From': spammer, 'To': FROM_PHONE, 'Body': 'WIN A CRUISE'}),
+        ('/wrongnumber/sms', '', {'From': spammer, 'To': PAGER_PHONE, 'Body': 'WIN A CRUISE'}),
+    ]
+
+def robocall_scenario(rng, ctx):
+    # A handful of numbers calling and texting over and over, which admission control should shed
+    robocaller = '+1202555{:04d}'.format(rng.randrange(3))
+    return [
+        ('/public/answer', '', {'From': robocaller, 'To': PAGER_PHONE, 'CallSid': 'CA' + uuid.uuid4().hex}),
+        ('/msgcontrol/entry', '', {'From': robocaller, 'To': FROM_PHONE, 'Body': 'STOP'}),
+    ]
+
+SCENARIOS = {
+    'voicemail': voicemail_scenario,
+    'take': take_scenario,
+    'who': who_scenario,
+    'spam': spam_scenario,
+    'robocall': robocall_scenario,
+}
+
+# ---- Transports: the Flask app in this process, or a running server over HTTP ----
+
+class InProcessTransport(object):
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, path, query, form):
+        rsp = self.client.post(path, query_string=query, data=form)
+        return rsp.status_code
+
+class HTTPTransport(object):
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def post(self, path, query, form):
+        url = self.base_url + path + ('?' + query if query else '')
+        try:
+            with self.opener.open(url, data=urlencode(form).encode(), timeout=60) as rsp:
+                rsp.read()
+                return rsp.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+def run_virtual_user(vu_id, make_transport, args, ctx, deadline, results):
+    rng = random.Random(args.seed * 1000003 + vu_id)
+    names, weights = zip(*ctx['mix'])
+    samples = []
+    while time.monotonic() < deadline:
+        # A fresh transport per scenario, so nothing carries over between exchanges; SMS sessions are kept
+        # on the server, keyed by the From number the scenario picks
+        transport = make_transport()
+        for path, query, form in SCENARIOS[rng.choices(names, weights)[0]](rng, ctx):
+            started = time.perf_counter()
+            try:
+                status = transport.post(path, query, form)
+            except Exception:
+                status = None
+            samples.append((path, time.perf_counter() - started, status == 200))
+    results[vu_id] = samples
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def report(samples, elapsed):
+    by_route = defaultdict(list)
+    errors = defaultdict(int)
+    for path, latency, ok in samples:
+        by_route[path].append(latency)
+        if not ok:
+            errors[path] += 1
+    print('{:<24} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}'.format('route', 'count', 'errors', 'req/s', 'p50 ms', 'p99 ms', 'max ms'))
+    for path in sorted(by_route):
+        latencies = sorted(by_route[path])
+        print('{:<24} {:>8} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            path, len(latencies), errors[path], len(latencies) / elapsed,
+            percentile(latencies, 0.50) * 1000, percentile(latencies, 0.99) * 1000, latencies[-1] * 1000))
+    print('{:<24} {:>8} {:>7} {:>9.1f}'.format('TOTAL', len(samples), sum(errors.values()), len(samples) / elapsed))
+    print()
+    for name in sorted(STATS.counts):
+        print('{:<32} {:>8}'.format(name, STATS.counts[name]))
+
+def parse_mix(text):
+    mix = []
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError('unknown scenario {} (choose from {})'.format(name, ', '.join(sorted(SCENARIOS))))
+        mix.append((name, float(weight or 1)))
+    return mix
+
+def cmd_fakes(args):
+    env = start_fakes(args)
+    for name, value in sorted(env.items()):
+        print('export {}="{}"'.format(name, value))
+    print('# Stand-ins running; Ctrl-C to stop', flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+def cmd_run(args):
+    wait_for_deliveries = None
+    if args.url:
+        media_base_url = os.getenv('LOADGEN_MEDIA_BASE_URL')
+        if not media_base_url:
+            raise SystemExit('Export the variables printed by "loadgen.py fakes" before driving a server over HTTP')
+        make_transport = lambda: HTTPTransport(args.url)
+    else:
+        env = start_fakes(args)
+        os.environ.update(env)
+        media_base_url = env['LOADGEN_MEDIA_BASE_URL']
+        import logging
+        import oncall
+        logging.getLogger().setLevel(logging.WARNING)
+        app = oncall.app
+        make_transport = lambda: InProcessTransport(app)
+        wait_for_deliveries = oncall.wait_for_deliveries
+    ctx = {'mix': args.mix, 'team_size': args.team_size, 'media_base_url': media_base_url}
+    results = dict()
+    started = time.monotonic()
+    deadline = started + args.duration
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for vu_id in range(args.concurrency):
+            pool.submit(run_virtual_user, vu_id, make_transport, args, ctx, deadline, results)
+    elapsed = time.monotonic() - started
+    time.sleep(args.drain)
+    # The in-process app would otherwise be torn down under recordings it is still delivering
+    if wait_for_deliveries is not None and not wait_for_deliveries(60):
+        print('# Some recording deliveries were still running at exit', file=sys.stderr)
+    report([sample for samples in results.values() for sample in samples], elapsed)
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay Twilio webhook traffic against the on-call app with local stand-ins for S3, Twilio and SMTP.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, func in (('run', cmd_run), ('fakes', cmd_fakes)):
+        sub = subparsers.add_parser(name)
+        sub.set_defaults(func=func)
+        sub.add_argument('--s3-latency', type=float, default=0.0, help='seconds added to each S3 request')
+        sub.add_argument('--twilio-latency', type=float, default=0.0, help='seconds added to each Twilio REST request')
+        sub.add_argument('--media-latency', type=float, default=0.0, help='seconds added to each recording download')
+        sub.add_argument('--smtp-latency', type=float, default=0.0, help='seconds added to each SMTP message')
+        sub.add_argument('--team-size', type=int, default=5)
+        sub.add_argument('--recording-kb', type=int, default=256)
+        sub.add_argument('--admission', action='store_true', help="keep the app's admission limits on (they are off by default)")
+        sub.add_argument('--escalation-tiers', type=int, default=0, help='page the rest of the team in this many tiers on every voicemail')
+    run = subparsers.choices['run']
+    run.add_argument('--url', help='drive a running server (e.g. gunicorn) instead of the app in this process')
+    run.add_argument('--concurrency', type=int, default=8)
+    run.add_argument('--duration', type=float, default=10.0, help='seconds to generate load')
+    run.add_argument('--mix', type=parse_mix, default=parse_mix('voicemail=1,take=1,who=2,spam=4'), help='scenario weights, e.g. voicemail=1,who=2')
+    run.add_argument('--drain', type=float, default=2.0, help='seconds to let background deliveries finish before reporting')
+    run.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Lightweight in-process metrics and trace IDs.
+
+Latency histograms and counters are kept per process and rendered in the
+Prometheus text exposition format for the /metrics route. Recording a sample
+costs a lock acquisition, a bisect and two additions.
+
+A trace ID identifies one call or message as it moves through webhooks, the
+delivery pool and the outbox. It lives in a context variable and is stamped on
+every log record as %(trace_id)s.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import contextvars
+import logging
+import threading
+import time
+import uuid
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry_lock = threading.Lock()
+_registry = dict()
+
+class Counter(object):
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._lock = threading.Lock()
+        self._values = dict()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in sorted(values):
+            lines.append('{}{} {}'.format(self.name, _format_labels(key), value))
+        return lines
+
+class Histogram(object):
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = dict()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            snapshot = [(key, list(series[0]), series[1]) for key, series in self._series.items()]
+        for key, counts, total in sorted(snapshot):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(self.name, _format_labels(key + (('le', le),)), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, _format_labels(key), total))
+            lines.append('{}_count{} {}'.format(self.name, _format_labels(key), cumulative))
+        return lines
+
+def _format_labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in key) + '}'
+
+def counter(name, help_text):
+    return _register(name, lambda: Counter(name, help_text))
+
+def histogram(name, help_text, buckets=DEFAULT_BUCKETS):
+    return _register(name, lambda: Histogram(name, help_text, buckets))
+
+def _register(name, factory):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = factory()
+        return metric
+
+def render():
+    """All registered metrics in Prometheus text format"""
+    with _registry_lock:
+        metrics = [_registry[name] for name in sorted(_registry)]
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+EXTERNAL_LATENCY = histogram('oncall_external_call_seconds', 'Latency of calls to S3, Twilio and SMTP, by operation')
+EXTERNAL_ERRORS = counter('oncall_external_call_errors_total', 'Calls to S3, Twilio and SMTP that raised, by operation')
+
+@contextmanager
+def timed(operation):
+    """Record the latency of one external call, and count it as an error if it raises"""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        EXTERNAL_ERRORS.inc(operation=operation)
+        raise
+    finally:
+        EXTERNAL_LATENCY.observe(time.perf_counter() - started, operation=operation)
+
+_trace_id = contextvars.ContextVar('oncall_trace_id', default='-')
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+def current_trace_id():
+    return _trace_id.get()
+
+def set_trace_id(trace_id):
+    _trace_id.set(trace_id or new_trace_id())
+
+def install_trace_logging():
+    """Stamp every log record with the current trace ID so formats can use %(trace_id)s"""
+    base_factory = logging.getLogRecordFactory()
+    if getattr(base_factory, 'adds_trace_id', False):
+        return
+    def record_factory(*args, **kwargs):
+        record = base_factory(*args, **kwargs)
+        record.trace_id = _trace_id.get()
+        return record
+    record_factory.adds_trace_id = True
+    logging.setLogRecordFactory(record_factory)
@@ -1,43 +1,140 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import time
 from datetime import datetime
 import os
 import logging
-import boto3
 import json
 from flask import (
         Flask,
-        session,
-        redirect,
+        Response,
+        abort,
+        g,
         url_for,
         request
 )
 from flask_mail import Mail, Message
 from dotenv import load_dotenv
-from twilio.twiml.voice_response import VoiceResponse, Gather, Record
+from twilio.twiml.voice_response import VoiceResponse, Gather
 from twilio.twiml.messaging_response import MessagingResponse
-from twilio.rest import Client
 from urllib.parse import urlencode
-import urllib
+import tempfile
+import threading
+import admission
+import archive
+import clients
+import escalation
+import metrics
+import outbox
+import sessions
 import whos_oncall
 
 load_dotenv()
-logging.basicConfig(level=logging.DEBUG)
-client = Client(os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"))
+metrics.install_trace_logging()
+logging.basicConfig(level=os.getenv('ONCALL_LOG_LEVEL', 'INFO').upper(), format='%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s', force=True)
 
 app = Flask(__name__)
-app.secret_key = b")DFNG'96.xCn]Vfd^!Cy"
-app.config.update(
-            MAIL_SERVER=whos_oncall.get_current_mail_server(),
-            MAIL_PORT=whos_oncall.get_current_mail_port(),
-            MAIL_USE_TLS=whos_oncall.get_current_mail_use_tls(),
-            MAIL_USERNAME=whos_oncall.get_current_mail_username(),
-            MAIL_PASSWORD=whos_oncall.get_current_mail_password(),
-            PERMANENT_SESSION_LIFETIME=whos_oncall.get_current_session_lifetime(),
-        )
-mailer = Mail(app)
+# Message needs the extension registered; mail is sent by clients.send_mail with each team's settings
+Mail(app)
+# Recording deliveries run here so the recording callback can answer Twilio right away
+delivery_pool = ThreadPoolExecutor(max_workers=int(os.getenv('ONCALL_DELIVERY_WORKERS', '4')), thread_name_prefix='delivery')
+# Delivery steps submitted but not yet finished, so a stopping worker can let them complete
+_pending_deliveries = 0
+_deliveries_done = threading.Condition()
+RECORDING_CHUNK_SIZE = 64 * 1024
+# S3 requires every part but the last to be at least 5 MiB
+S3_PART_SIZE = 8 * 1024 * 1024
+# How many future shifts WHO lists when the config has a schedule
+WHO_UPCOMING_SHIFTS = 3
+
+REQUEST_LATENCY = metrics.histogram('oncall_http_request_seconds', 'Webhook handling time, by route')
+RESPONSES = metrics.counter('oncall_http_responses_total', 'Responses sent, by route and status')
+SHED = metrics.counter('oncall_admission_shed_total', 'Requests turned away by admission control, by route and reason')
+
+# Routes anyone can reach by calling or texting our numbers: the reply sent to a request that is
+# shed, and whether the route's shared limit applies. The SMS commands only do anything for team
+# members, so strangers flooding them are held back by their own numbers' limits alone.
+_SMS_SHED_REPLY = str(MessagingResponse())
+_VOICE_SHED_REPLY = str(VoiceResponse().reject())
+ADMISSION_ROUTES = {
+    '/public/answer': (_VOICE_SHED_REPLY, True),
+    '/wrongnumber/voice': (_VOICE_SHED_REPLY, True),
+    '/wrongnumber/sms': (_SMS_SHED_REPLY, True),
+    '/msgcontrol/entry': (_SMS_SHED_REPLY, False),
+    '/msgcontrol/take': (_SMS_SHED_REPLY, False),
+    '/msgcontrol/who': (_SMS_SHED_REPLY, False),
+    '/msgcontrol/help': (_SMS_SHED_REPLY, False),
+    '/msgcontrol/look': (_SMS_SHED_REPLY, False),
+    '/msgcontrol/confirm': (_SMS_SHED_REPLY, False),
+    '/msgcontrol/cancel': (_SMS_SHED_REPLY, False),
+    '/msgcontrol/ack': (_SMS_SHED_REPLY, False),
+}
+# Shed texts that somebody is waiting on get told so, rather than silence
+_MEMBER_SHED_REPLY = str(MessagingResponse().message('Too many messages from this number just now. Wait a minute and send that again.'))
+_ACK_SHED_REPLY = str(MessagingResponse().message('Too many messages from this number just now, so your ACK was not processed. '
+                                                  'Send ACK again in a minute, or press 1 on the page call.'))
+_ACK_BODIES = ('ack', 'a')
+
+@app.before_request
+def start_request_trace():
+    g.request_started = time.perf_counter()
+    metrics.set_trace_id(request.args.get('OnmsTraceId') or request.headers.get('X-Request-Id'))
+
+@app.after_request
+def finish_request_trace(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUEST_LATENCY.observe(time.perf_counter() - g.request_started, route=route)
+    RESPONSES.inc(route=route, status=response.status_code)
+    response.headers['X-Trace-Id'] = metrics.current_trace_id()
+    return response
+
+@app.before_request
+def admit_request():
+    """Shed floods from one number, or at one route, before they cost a config lookup. Callers
+    are rejected (Twilio does not bill a rejected call) and texts from strangers get an empty reply.
+    A number with a live SMS session is a team member: its texts have an allowance of their own,
+    an ACK from it is always let through, and it is told when a text is shed, as is anyone whose
+    ACK is."""
+    route = request.url_rule.rule if request.url_rule else None
+    if route not in ADMISSION_ROUTES or request.method != 'POST':
+        return None
+    shed_reply, route_limited = ADMISSION_ROUTES[route]
+    sender = request.values.get('From', '')
+    member = route.startswith('/msgcontrol/') and sessions.store.is_active(sender)
+    ack = route == '/msgcontrol/ack' or (route == '/msgcontrol/entry' and request.values.get('Body', '').lower().strip() in _ACK_BODIES)
+    if member and ack:
+        return None
+    reason = admission.admit(route, sender, member=member, route_limited=route_limited)
+    if reason is None:
+        return None
+    SHED.inc(route=route, reason=reason)
+    logging.debug('Shedding %s from %s (%s limit)', route, sender, reason)
+    if ack:
+        return _ACK_SHED_REPLY
+    if member:
+        return _MEMBER_SHED_REPLY
+    return shed_reply
+
+@app.before_request
+def route_team():
+    """Serve each webhook from the config of the team that owns the dialed number. Our own
+    callback URLs carry OnmsTeam, since Twilio's To there is not one of the team's numbers.
+    Anything else (the metrics scrape, stray GETs) runs as the default team and loads no config."""
+    whos_oncall.use_team(None)
+    if request.method != 'POST':
+        return None
+    team_id = request.args.get('OnmsTeam')
+    if team_id is None:
+        team_id = whos_oncall.route_dialed_number(request.values.get('To', ''))
+    if team_id is None or team_id not in whos_oncall.TEAM_IDS:
+        logging.warning('No team serves dialed number %s, ignoring %s', request.values.get('To'), request.path)
+        return str(VoiceResponse())
+    whos_oncall.use_team(team_id)
+    return None
 
 @app.before_request
-def make_session_permanent():
-    session.permanent = True
+def start_outbox():
+    outbox.ensure_running()
 
 @app.route('/')
 @app.route('/public')
@@ -46,6 +143,14 @@ def make_session_permanent():
 def home():
     return "<html><h1>Invalid request</h1></html>"
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint. Values are per worker process."""
+    token = os.getenv('ONCALL_METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != 'Bearer ' + token:
+        abort(403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route("/wrongnumber/sms", methods=['POST'])
 def wrongnumber_sms():
     """Helpful entry point for texts sent to voice numbers"""
@@ -80,7 +185,7 @@ def public_answer():
     dest_num = request.values.get('To', '')
     logging.info('Voice call to voice number %s from caller %s.', dest_num, incoming_num)
     resp = VoiceResponse()
-    gather = Gather(num_digits=1, action=url_for('public_keypress'), method="POST")
+    gather = Gather(num_digits=1, action=url_for('public_keypress', OnmsTraceId=metrics.current_trace_id()), method="POST")
     gather.say("Press 1 to leave a message for the Open N M S on-call engineer.", voice='alice')
     gather.pause(length=10)
     resp.append(gather)
@@ -114,9 +219,7 @@ def public_recordingcb():
     logging.info('Recording callback invoked with RecordingStatus=%s', rec_status)
     resp = VoiceResponse()
     if rec_status == 'completed':
-        _deliver_mms(resp, request)
-        _deliver_email(resp, request)
-        _persist_recording(resp, request)
+        _dispatch_delivery(resp, request)
     elif rec_status == 'failed':
         _record_failed(resp, request)
     else:
@@ -132,146 +235,224 @@ def public_mmsstatuscb():
     logging.debug('Message status DUMP: %s', request.values)
     if (message_status == 'failed' or message_status == 'undelivered'):
         logging.error('Message with SID %s has unacceptable status: %s', message_sid, message_status)
+        outbox.requeue_by_ref(message_sid, 'MMS status {} (error code {})'.format(message_status, request.values.get('ErrorCode')))
     return ('', 204)
 
+@app.route("/escalation/call", methods=['POST'])
+def escalation_call():
+    """A page call was answered. Read out the page and ask for an acknowledgement."""
+    page_id = request.args.get('OnmsPageId')
+    resp = VoiceResponse()
+    page = escalation.get_page(page_id)
+    if page is None:
+        logging.warning('Page call %s answered for unknown page %s', request.values.get('CallSid'), page_id)
+        resp.hangup()
+        return str(resp)
+    summary, acked_by = page
+    if acked_by is not None:
+        resp.say('This page was already acknowledged by {}. Goodbye.'.format(acked_by), voice='alice')
+        resp.hangup()
+        return str(resp)
+    gather = Gather(num_digits=1, action=url_for('escalation_ack', OnmsPageId=page_id, OnmsTeam=whos_oncall.get_current_team(), OnmsTraceId=metrics.current_trace_id()), method="POST")
+    gather.say('On-call page: {}. Press 1 to acknowledge.'.format(summary), voice='alice')
+    gather.pause(length=5)
+    resp.append(gather)
+    resp.say('The page was not acknowledged. Goodbye.', voice='alice')
+    resp.hangup()
+    return str(resp)
+
+@app.route("/escalation/ack", methods=['POST'])
+def escalation_ack():
+    """The person answering a page call pressed a key. 1 acknowledges the page and stops escalation."""
+    page_id = request.args.get('OnmsPageId')
+    resp = VoiceResponse()
+    if request.form.get('Digits') != '1':
+        resp.redirect(url_for('escalation_call', OnmsPageId=page_id, OnmsTeam=whos_oncall.get_current_team(), OnmsTraceId=metrics.current_trace_id()))
+        return str(resp)
+    friend = whos_oncall.lookup_user_by_phone(request.form.get('To', ''))
+    acked_by = friend['name'] if friend is not None else request.form.get('To', 'an unknown number')
+    if escalation.acknowledge(page_id, acked_by, answering_call_sid=request.form.get('CallSid')):
+        resp.say('Thank you, {}. The page is acknowledged and escalation has stopped.'.format(acked_by), voice='alice')
+    else:
+        page = escalation.get_page(page_id)
+        resp.say('This page was already acknowledged by {}. Goodbye.'.format(page[1] if page is not None else 'somebody else'), voice='alice')
+    resp.hangup()
+    return str(resp)
+
 @app.route("/msgcontrol/entry", methods=['POST'])
 def msgcontrol_entry():
     incoming_msg = request.values.get('Body', '').lower().strip()
     incoming_num = request.values.get('From', '')
     resp = MessagingResponse()
-    friend = None
-    if 'user_dict' in session:
-        friend = session['user_dict']
+    sms_session = _load_sms_session(incoming_num)
+    friend = sms_session.get('user_dict')
+    if friend is not None:
         logging.info('Retrieved friend identity from session')
     else:
         friend = whos_oncall.lookup_user_by_phone(incoming_num)
         if friend != None:
-            session['user_dict'] = friend
+            sms_session['user_dict'] = friend
             logging.info('Looked up friend identity from config, stored in session')
     if friend == None:
         logging.info("Ignoring message from unknown number %s", incoming_num)
         return str(resp)
-    if 'take' in incoming_msg:
-        resp.redirect(url_for('msgcontrol_take'))
-    elif 'who' in incoming_msg:
-        resp.redirect(url_for('msgcontrol_who'))
-    elif 'c' == incoming_msg:
-        resp.redirect(url_for('msgcontrol_confirm'))
-    elif 'x' == incoming_msg:
-        resp.redirect(url_for('msgcontrol_cancel'))
-    elif 'look' in incoming_msg:
-        resp.redirect(url_for('msgcontrol_look'))
-    elif 'halp' in incoming_msg:
-        resp.redirect(url_for('msgcontrol_help'))
-    else:
-        resp.redirect(url_for('msgcontrol_help'))
+    handler = _resolve_msgcontrol_handler(incoming_msg)
+    handler(resp, friend, incoming_msg)
+    _save_sms_session(incoming_num, sms_session)
     return str(resp)
 
+# The per-verb routes below predate inline dispatch from msgcontrol_entry. They remain
+# so that TwiML redirects issued by older deployments still land somewhere sensible.
+
 @app.route("/msgcontrol/take", methods=['POST'])
 def msgcontrol_take():
+    return _msgcontrol_compat(_msgcontrol_take)
+
+@app.route("/msgcontrol/who", methods=['POST'])
+def msgcontrol_who():
+    return _msgcontrol_compat(_msgcontrol_who)
+
+@app.route("/msgcontrol/help", methods=['POST'])
+def msgcontrol_help():
+    return _msgcontrol_compat(_msgcontrol_help)
+
+@app.route("/msgcontrol/look", methods=['POST'])
+def msgcontrol_look():
+    return _msgcontrol_compat(_msgcontrol_look)
+
+@app.route("/msgcontrol/confirm", methods=['POST'])
+def msgcontrol_confirm():
+    return _msgcontrol_compat(_msgcontrol_confirm)
+
+@app.route("/msgcontrol/cancel", methods=['POST'])
+def msgcontrol_cancel():
+    return _msgcontrol_compat(_msgcontrol_cancel)
+
+@app.route("/msgcontrol/ack", methods=['POST'])
+def msgcontrol_ack():
+    return _msgcontrol_compat(_msgcontrol_ack)
+
+def _msgcontrol_compat(handler):
     incoming_msg = request.values.get('Body', '').lower().strip()
     incoming_num = request.values.get('From', '')
     resp = MessagingResponse()
-    user_dict = session.get('user_dict')
+    sms_session = _load_sms_session(incoming_num)
+    user_dict = sms_session.get('user_dict')
     if user_dict == None:
         logging.info('No user_dict in session. Bailing.')
         return str(resp)
+    handler(resp, user_dict, incoming_msg)
+    _save_sms_session(incoming_num, sms_session)
+    return str(resp)
+
+def _load_sms_session(incoming_num):
+    """The sender's server-side session (see sessions.py), also kept in g for the verb handlers"""
+    g.sms_session = sessions.store.get(whos_oncall.get_current_team(), incoming_num, whos_oncall.get_current_session_lifetime()) or dict()
+    return g.sms_session
+
+def _save_sms_session(incoming_num, sms_session):
+    sessions.store.save(whos_oncall.get_current_team(), incoming_num, sms_session, whos_oncall.get_current_session_lifetime())
+
+def _resolve_msgcontrol_handler(incoming_msg):
+    """Map an SMS body to the handler for its verb; C and X are checked against active_flow by their handlers.
+    ACK must be the whole message, since acknowledging stops escalation for every open page."""
+    if 'take' in incoming_msg:
+        return _msgcontrol_take
+    elif 'who' in incoming_msg:
+        return _msgcontrol_who
+    elif incoming_msg in _ACK_BODIES:
+        return _msgcontrol_ack
+    elif 'c' == incoming_msg:
+        return _msgcontrol_confirm
+    elif 'x' == incoming_msg:
+        return _msgcontrol_cancel
+    elif 'look' in incoming_msg:
+        return _msgcontrol_look
+    else:
+        return _msgcontrol_help
+
+def _msgcontrol_take(resp, user_dict, incoming_msg):
     current_oncall_user = whos_oncall.get_current_oncall_user()
     if user_dict['id'] == current_oncall_user['id']:
         resp.message('You are already on call, {}. Nothing changes.'.format(user_dict['name']))
-        return str(resp)
+        return resp
     resp.message(user_dict['name'] + ' to be made on-call engineer, reply C to confirm or X to cancel')
-    session['active_flow'] = 'take'
-    return str(resp)
+    g.sms_session['active_flow'] = 'take'
+    return resp
 
-@app.route("/msgcontrol/who", methods=['POST'])
-def msgcontrol_who():
-    incoming_msg = request.values.get('Body', '').lower().strip()
-    incoming_num = request.values.get('From', '')
-    resp = MessagingResponse()
-    user_dict = session.get('user_dict')
-    if user_dict == None:
-        logging.info('No user_dict in session. Bailing.')
-        return str(resp)
+def _msgcontrol_who(resp, user_dict, incoming_msg):
     current_oncall_user = whos_oncall.get_current_oncall_user()
     modified_time = str(datetime.fromtimestamp(whos_oncall.get_oncall_config_last_modified_time()))
     modified_user = whos_oncall.get_oncall_config_last_modified_user_id()
-    resp.message('Current on-call engineer: {} <{}>.\nLast modified {} by {}.'.format(current_oncall_user['name'], current_oncall_user['phone'], modified_time, modified_user))
-    return str(resp)
+    message = 'Current on-call engineer: {} <{}>.\nLast modified {} by {}.'.format(current_oncall_user['name'], current_oncall_user['phone'], modified_time, modified_user)
+    upcoming_shifts = whos_oncall.get_upcoming_oncall_shifts(WHO_UPCOMING_SHIFTS + 1)
+    if upcoming_shifts and upcoming_shifts[0].start <= time.time():
+        upcoming_shifts = upcoming_shifts[1:]
+    if upcoming_shifts:
+        users = whos_oncall.get_available_oncall_users()
+        message += '\n\nComing up:\n' + '\n'.join(' {} from {}'.format(users[shift.user_id]['name'], datetime.fromtimestamp(shift.start).strftime('%a %b %d %H:%M'))
+                                                    for shift in upcoming_shifts[:WHO_UPCOMING_SHIFTS])
+    resp.message(message)
+    return resp
 
-@app.route("/msgcontrol/help", methods=['POST'])
-def msgcontrol_help():
-    incoming_msg = request.values.get('Body', '').lower().strip()
-    incoming_num = request.values.get('From', '')
-    resp = MessagingResponse()
-    user_dict = session.get('user_dict')
-    if user_dict == None:
-        logging.info('No user_dict in session. Bailing.')
-        return str(resp)
-    resp.message('Hi there, {}. Commands I understand:\n\n TAKE\n WHO\n HALP\n'.format(user_dict['name']))
-    return str(resp)
+def _msgcontrol_ack(resp, user_dict, incoming_msg):
+    page_ids = escalation.acknowledge_open_pages(whos_oncall.get_current_team(), user_dict['name'])
+    if not page_ids:
+        resp.message('No open pages to acknowledge, {}.'.format(user_dict['name']))
+        return resp
+    resp.message('Thanks, {}. Acknowledged {} open page(s); escalation has stopped.'.format(user_dict['name'], len(page_ids)))
+    return resp
 
-@app.route("/msgcontrol/look", methods=['POST'])
-def msgcontrol_look():
-    incoming_msg = request.values.get('Body', '').lower().strip()
-    incoming_num = request.values.get('From', '')
-    resp = MessagingResponse()
-    user_dict = session.get('user_dict')
-    if user_dict == None:
-        logging.info('No user_dict in session. Bailing.')
-        return str(resp)
+def _msgcontrol_help(resp, user_dict, incoming_msg):
+    resp.message('Hi there, {}. Commands I understand:\n\n TAKE\n WHO\n ACK\n HALP\n'.format(user_dict['name']))
+    return resp
+
+def _msgcontrol_look(resp, user_dict, incoming_msg):
     logging.warn('%s must be very proud of finding the LOOK verb!', user_dict['name'])
     resp.message('HELLO {}.\n\nYOU ARE IN A MAZE OF TWISTY LITTLE PASSAGES, ALL ALIKE.\n\n>_'.format(user_dict['name'].upper()))
-    return str(resp)
+    return resp
 
-@app.route("/msgcontrol/confirm", methods=['POST'])
-def msgcontrol_confirm():
-    incoming_msg = request.values.get('Body', '').lower().strip()
-    incoming_num = request.values.get('From', '')
-    resp = MessagingResponse()
-    user_dict = session.get('user_dict')
-    if user_dict == None:
-        logging.info('No user_dict in session. Bailing.')
-        return str(resp)
-    if session.get('active_flow') != 'take':
-        logging.info('Got what looks like a take-confirmation, but active_flow is {}. Session expired?'.format(session.get('active_flow')))
+def _msgcontrol_confirm(resp, user_dict, incoming_msg):
+    if g.sms_session.get('active_flow') != 'take':
+        logging.info('Got what looks like a take-confirmation, but active_flow is {}. Session expired?'.format(g.sms_session.get('active_flow')))
         resp.message('No session. Issue TAKE again and confirm within {} seconds.'.format(whos_oncall.get_current_session_lifetime()))
-        return str(resp)
+        return resp
     if 'c' != incoming_msg:
         logging.info('This URL is for take-confirmation but the message body {} does not fit. Bailing.'.format(incoming_msg))
-        return str(resp)
-    whos_oncall.set_current_oncall_user(user_dict['id'], user_dict['id'])
-    resp.message('Okay, {}, you are now on call. Please leave a message at {} to complete the flow and test delivery.'.format(user_dict['name'], whos_oncall.get_current_pager_phone()))
-    session.pop('active_flow', '')
-    return str(resp)
+        return resp
+    try:
+        whos_oncall.set_current_oncall_user(user_dict['id'], user_dict['id'])
+    except whos_oncall.ConfigWriteConflict:
+        logging.exception('Could not record %s as on call', user_dict['id'])
+        resp.message('Sorry, {}, the on-call config is changing too fast to update right now. Reply C again to retry.'.format(user_dict['name']))
+        return resp
+    shift = whos_oncall.get_current_oncall_shift()
+    until = ' until {}'.format(datetime.fromtimestamp(shift.end).strftime('%a %b %d %H:%M')) if shift is not None else ''
+    resp.message('Okay, {}, you are now on call{}. Please leave a message at {} to complete the flow and test delivery.'.format(user_dict['name'], until, whos_oncall.get_current_pager_phone()))
+    g.sms_session.pop('active_flow', '')
+    return resp
 
-@app.route("/msgcontrol/cancel", methods=['POST'])
-def msgcontrol_cancel():
-    incoming_msg = request.values.get('Body', '').lower().strip()
-    incoming_num = request.values.get('From', '')
-    resp = MessagingResponse()
-    user_dict = session.get('user_dict')
-    if user_dict == None:
-        logging.info('No user_dict in session. Bailing.')
-        return str(resp)
-    if session.get('active_flow') != 'take':
-        logging.info('Got what looks like a take-cancel, but active_flow is {}. Session expired?'.format(session.get('active_flow')))
-        return str(resp)
+def _msgcontrol_cancel(resp, user_dict, incoming_msg):
+    if g.sms_session.get('active_flow') != 'take':
+        logging.info('Got what looks like a take-cancel, but active_flow is {}. Session expired?'.format(g.sms_session.get('active_flow')))
+        return resp
     if 'x' != incoming_msg:
         logging.info('This URL is for take-cancel but the message body {} does not fit. Bailing.'.format(incoming_msg))
-        return str(resp)
+        return resp
     resp.message('Okay, {}, nothing changes: {} remains on call.'.format(user_dict['name'], whos_oncall.get_current_oncall_user()['name']))
-    session.pop('active_flow', '')
-    return str(resp)
+    g.sms_session.pop('active_flow', '')
+    return resp
 
 def _record_message(resp, request):
     relay_vars = {'OnmsOrigFrom': request.form['From'],
                   'OnmsOrigFromCity': request.form['FromCity'],
                   'OnmsOrigFromState': request.form['FromState'],
                   'OnmsOrigCallerName': request.form['CallerName'],
-                  'OnmsOrigCallSid': request.form['CallSid']}
+                  'OnmsOrigCallSid': request.form['CallSid'],
+                  'OnmsTraceId': metrics.current_trace_id(),
+                  'OnmsTeam': whos_oncall.get_current_team()}
     relay_query = urlencode(relay_vars)
-    resp.record(action=url_for('public_afterrec'), max_length=300, recording_status_callback=url_for('public_recordingcb') + '?' + relay_query, recording_status_callback_event='completed absent', recording_status_callback_method='POST')
+    resp.record(action=url_for('public_afterrec', OnmsTraceId=metrics.current_trace_id()), max_length=300, recording_status_callback=url_for('public_recordingcb') + '?' + relay_query, recording_status_callback_event='completed absent', recording_status_callback_method='POST')
     return resp
 
 def _coalesce_call_details(resp, request):
@@ -286,47 +467,179 @@ def _coalesce_call_details(resp, request):
         details['caller_name'] = 'Unknown Caller'
     details['rec_len'] = request.form['RecordingDuration']
     details['rec_url'] = '{}.mp3'.format(request.form['RecordingUrl'])
+    details['trace_id'] = metrics.current_trace_id()
     return details
 
-def _deliver_mms(resp, request):
+def _dispatch_delivery(resp, request):
+    """Hand the recording off to the delivery pool; everything request-bound is resolved here"""
     call_details = _coalesce_call_details(resp, request)
-    logging.info('Call from %s, SID %s: Sending MMS of %s-second message from %s <%s> with MediaUrl=%s', call_details['caller_num'], call_details['orig_call_sid'], call_details['rec_len'], call_details['caller_name'], call_details['caller_num'], call_details['rec_url'])
-    msg = client.messages.create(
-                    body='On-Call voicemail ({} sec) received from {} <{}>'.format(call_details['rec_len'], call_details['caller_name'], call_details['caller_num']),
-                    from_=whos_oncall.get_current_from_phone(),
-                    to=whos_oncall.get_current_oncall_user()['phone'],
-                    media_url=call_details['rec_url'],
-                    status_callback='{}/{}'.format(os.getenv('ONCALL_APP_BASE_URL'), url_for('public_mmsstatuscb'))
-                )
-    logging.info('Submitted message with SID %s', msg.sid)
+    status_callback = '{}/{}'.format(os.getenv('ONCALL_APP_BASE_URL'), url_for('public_mmsstatuscb', OnmsTeam=whos_oncall.get_current_team()))
+    page_call_url = '{}{}'.format(os.getenv('ONCALL_APP_BASE_URL'), url_for('escalation_call', OnmsPageId=call_details['orig_call_sid'], OnmsTeam=whos_oncall.get_current_team(), OnmsTraceId=metrics.current_trace_id()))
+    _submit_delivery(_run_delivery_pipeline, call_details, status_callback, page_call_url)
     return resp
 
-def _deliver_email(resp, request):
-    call_details = _coalesce_call_details(resp, request)
-    logging.info('Building on-call e-mail from %s to %s', whos_oncall.get_current_from_email(), whos_oncall.get_current_to_email())
-    email = Message(
-                "[OnCall] New on-call voicemail",
-                sender=whos_oncall.get_current_from_email(),
-                recipients=[whos_oncall.get_current_to_email()],
-                body='On-Call voicemail ({} sec) received from {} <{}>. Audio: {}'.format(call_details['rec_len'], call_details['caller_name'], call_details['caller_num'], call_details['rec_url'])
-            )
-    logging.info('Attaching recording to on-call e-mail')
-    with urllib.request.urlopen(call_details['rec_url']) as rec_rsp:
-        email.attach("voicemail.mp3", "audio/mpeg", rec_rsp.read())
-    logging.info('Sending on-call e-mail')
-    mailer.send(email)
-    logging.info('Sent e-mail from %s to %s', whos_oncall.get_current_from_email(), whos_oncall.get_current_to_email())
-    return resp
+def _submit_delivery(fn, *args):
+    global _pending_deliveries
+    with _deliveries_done:
+        _pending_deliveries += 1
+    # Run in a copy of the caller's context so the trace ID follows the work onto the pool
+    future = delivery_pool.submit(contextvars.copy_context().run, fn, *args)
+    future.add_done_callback(_finish_delivery)
+    return future
 
-def _persist_recording(resp, request):
-    call_details = _coalesce_call_details(resp, request)
-    instant = datetime.now()
-    base_obj_name = 'recordings/{}'.format(instant.strftime('%Y-%m-%d_%H%M%S'))
-    s3c = boto3.client('s3')
-    with urllib.request.urlopen(call_details['rec_url']) as rec_rsp:
-        s3c.put_object(Bucket=os.getenv('BACKING_STORE_S3_BUCKET'), Key=base_obj_name + '.mp3', Body=rec_rsp.read())
-        s3c.put_object(Bucket=os.getenv('BACKING_STORE_S3_BUCKET'), Key=base_obj_name + '.json', Body=json.dumps(call_details, sort_keys=True, indent=4))
-    return resp
+def _finish_delivery(future):
+    global _pending_deliveries
+    exc = future.exception()
+    if exc is not None:
+        logging.error('Recording delivery step failed', exc_info=exc)
+    with _deliveries_done:
+        _pending_deliveries -= 1
+        _deliveries_done.notify_all()
+
+def wait_for_deliveries(timeout):
+    """Block until every delivery step handed to the pool has finished (steps a step submits
+    included), or timeout seconds pass. Returns whether they all finished."""
+    with _deliveries_done:
+        return _deliveries_done.wait_for(lambda: _pending_deliveries == 0, timeout)
+
+def _run_delivery_pipeline(call_details, status_callback, page_call_url):
+    """Queue the MMS and page calls straight away, spool the recording to disk once, then hand it to e-mail and S3"""
+    _deliver_mms(call_details, status_callback)
+    try:
+        _start_escalation(call_details, page_call_url)
+    except Exception:
+        logging.exception('Could not start escalation for call SID %s', call_details['orig_call_sid'])
+    try:
+        recording = _fetch_recording(call_details, consumers=2)
+    except Exception:
+        logging.exception('Could not fetch recording %s, e-mailing its link only', call_details['rec_url'])
+        _deliver_email(call_details, None)
+        raise
+    _submit_delivery(_deliver_email, call_details, recording)
+    _submit_delivery(_persist_recording, call_details, recording)
+
+class _SpooledRecording:
+    """A downloaded recording on local disk, removed once each of its consumers has released it"""
+    def __init__(self, path, consumers):
+        self.path = path
+        self._consumers = consumers
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            self._consumers -= 1
+            done = self._consumers == 0
+        if done:
+            os.unlink(self.path)
+
+def _fetch_recording(call_details, consumers):
+    logging.info('Call from %s, SID %s: Fetching recording %s', call_details['caller_num'], call_details['orig_call_sid'], call_details['rec_url'])
+    fd, path = tempfile.mkstemp(prefix='oncall-rec-', suffix='.mp3', dir=os.getenv('ONCALL_SPOOL_DIR'))
+    try:
+        with os.fdopen(fd, 'wb') as spool, metrics.timed('twilio.recording_download'):
+            clients.fetch_media(call_details['rec_url'], spool, RECORDING_CHUNK_SIZE)
+    except Exception:
+        os.unlink(path)
+        raise
+    return _SpooledRecording(path, consumers)
+
+def _deliver_mms(call_details, status_callback):
+    logging.info('Call from %s, SID %s: Queueing MMS of %s-second message from %s <%s> with MediaUrl=%s', call_details['caller_num'], call_details['orig_call_sid'], call_details['rec_len'], call_details['caller_name'], call_details['caller_num'], call_details['rec_url'])
+    outbox.enqueue('mms', {
+                    'body': 'On-Call voicemail ({} sec) received from {} <{}>'.format(call_details['rec_len'], call_details['caller_name'], call_details['caller_num']),
+                    'from_': whos_oncall.get_current_from_phone(),
+                    'to': whos_oncall.get_current_oncall_user()['phone'],
+                    'media_url': call_details['rec_url'],
+                    'status_callback': status_callback
+                })
+
+def _start_escalation(call_details, page_call_url):
+    """Phone the on-call engineer now and each escalation tier once its delay passes; off unless the config has tiers"""
+    tiers = whos_oncall.get_escalation_tiers()
+    if not tiers:
+        return
+    users = whos_oncall.get_available_oncall_users()
+    primary = whos_oncall.get_current_oncall_user()
+    plan = [(0, [primary['phone']])]
+    for tier in tiers:
+        phones = [users[user_id]['phone'] for user_id in tier['user_ids'] if user_id != primary['id']]
+        if phones:
+            plan.append((tier['after'], phones))
+    summary = '{} second voicemail from {}'.format(call_details['rec_len'], call_details['caller_name'])
+    escalation.start_page(call_details['orig_call_sid'], whos_oncall.get_current_team(), summary, plan, page_call_url, whos_oncall.get_current_from_phone())
+
+def _deliver_email(call_details, recording):
+    try:
+        from_email = whos_oncall.get_current_from_email()
+        to_email = whos_oncall.get_current_to_email()
+        logging.info('Queueing on-call e-mail from %s to %s', from_email, to_email)
+        outbox.enqueue('email', {
+                    'subject': "[OnCall] New on-call voicemail",
+                    'sender': from_email,
+                    'recipients': [to_email],
+                    'team': whos_oncall.get_current_team(),
+                    'body': 'On-Call voicemail ({} sec) received from {} <{}>. Audio: {}'.format(call_details['rec_len'], call_details['caller_name'], call_details['caller_num'], call_details['rec_url'])
+                }, attachment_path=recording.path if recording is not None else None)
+    finally:
+        if recording is not None:
+            recording.release()
+
+def _send_mms(payload, attachment_path):
+    """Outbox handler for 'mms' deliveries"""
+    with metrics.timed('twilio.messages.create'):
+        msg = clients.get_twilio_client().messages.create(**payload)
+    logging.info('Submitted message to %s with SID %s', payload['to'], msg.sid)
+    return msg.sid
+
+def _send_email(payload, attachment_path):
+    """Outbox handler for 'email' deliveries"""
+    whos_oncall.use_team(payload.get('team'))
+    email = Message(payload['subject'], sender=payload['sender'], recipients=payload['recipients'], body=payload['body'])
+    with app.app_context():
+        if attachment_path is not None:
+            logging.info('Attaching recording to on-call e-mail')
+            # The MIME attachment needs the whole body, so this is the one place the audio is held in memory
+            with open(attachment_path, 'rb') as rec_file:
+                email.attach("voicemail.mp3", "audio/mpeg", rec_file.read())
+        with metrics.timed('smtp.send'):
+            clients.send_mail(email, whos_oncall.get_current_mail_settings())
+    logging.info('Sent e-mail from %s to %s', payload['sender'], ', '.join(payload['recipients']))
+    return None
+
+outbox.register_handler('mms', _send_mms, lane='sms', provider='twilio')
+outbox.register_handler('email', _send_email, lane='mail', provider='smtp')
+
+def _persist_recording(call_details, recording):
+    try:
+        instant = time.time()
+        team_id = whos_oncall.get_current_team()
+        # The call SID keeps two recordings made in the same second apart
+        base_obj_name = 'recordings/{}{}_{}'.format(team_id + '/' if team_id else '', datetime.fromtimestamp(instant).strftime('%Y-%m-%d_%H%M%S'), call_details['orig_call_sid'])
+        bucket = os.getenv('BACKING_STORE_S3_BUCKET')
+        s3c = clients.get_s3_client()
+        with open(recording.path, 'rb') as rec_file, metrics.timed('s3.put_recording'):
+            _stream_to_s3(s3c, bucket, base_obj_name + '.mp3', rec_file)
+        with metrics.timed('s3.put_recording_details'):
+            s3c.put_object(Bucket=bucket, Key=base_obj_name + '.json', Body=json.dumps(call_details, sort_keys=True, indent=4))
+        logging.info('Persisted recording and details for call SID %s as %s', call_details['orig_call_sid'], base_obj_name)
+    finally:
+        recording.release()
+    archive.record_recording(team_id, {
+                    'time': int(instant),
+                    'call_sid': call_details['orig_call_sid'],
+                    'caller_num': call_details['caller_num'],
+                    'caller_name': call_details['caller_name'],
+                    'rec_len': call_details['rec_len'],
+                    'key': base_obj_name + '.mp3',
+                    'trace_id': call_details['trace_id'],
+                })
+
+def _stream_to_s3(s3c, bucket, key, fileobj):
+    """Upload fileobj in S3_PART_SIZE pieces, as a multipart upload once it outgrows a single part"""
+    from boto3.s3.transfer import TransferConfig
+    # The delivery pool already runs uploads side by side, so each one stays on its own thread
+    transfer_config = TransferConfig(multipart_threshold=S3_PART_SIZE, multipart_chunksize=S3_PART_SIZE, use_threads=False)
+    s3c.upload_fileobj(fileobj, bucket, key, Config=transfer_config)
 
 def _record_failed(resp, request):
     resp.say("Sorry, your message didn't record successfully. Let's try again.")
@@ -0,0 +1,272 @@
+"""Durable outbox for outbound notifications (MMS, e-mail) and other deferred work.
+
+Deliveries are written to a local SQLite journal before anything is sent, and
+background dispatchers drain the journal in batches, retrying with exponential
+backoff. Each kind of delivery belongs to a lane, and each lane has a dispatcher
+thread of its own, so an urgent page never queues behind a backlog of e-mail or
+index writes. Sends are paced per provider rather than per lane: Twilio messages
+at ONCALL_OUTBOX_SEND_RATE per second, SMTP at ONCALL_OUTBOX_SMTP_RATE, and kinds
+with no provider (S3 writes, dialing, which has its own limit) not at all. A delivery that later turns out to have failed (for instance
+an MMS whose status callback says "undelivered") can be put back in the queue by
+its provider reference. Several gunicorn workers on one host can share the journal;
+rows are claimed in a transaction so each is sent by one worker at a time.
+"""
+import contextlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+import metrics
+
+OUTBOX_DB = os.getenv('ONCALL_OUTBOX_DB', 'oncall-outbox.sqlite3')
+OUTBOX_DIR = os.getenv('ONCALL_OUTBOX_DIR', 'oncall-outbox')
+BATCH_SIZE = int(os.getenv('ONCALL_OUTBOX_BATCH_SIZE', '10'))
+SEND_RATE = float(os.getenv('ONCALL_OUTBOX_SEND_RATE', '5'))
+SMTP_RATE = float(os.getenv('ONCALL_OUTBOX_SMTP_RATE', '5'))
+MAX_ATTEMPTS = int(os.getenv('ONCALL_OUTBOX_MAX_ATTEMPTS', '8'))
+BACKOFF_BASE = float(os.getenv('ONCALL_OUTBOX_BACKOFF_BASE', '5'))
+BACKOFF_CAP = float(os.getenv('ONCALL_OUTBOX_BACKOFF_CAP', '600'))
+# Rows claimed by a worker that died mid-send become eligible again after this long
+CLAIM_TIMEOUT = float(os.getenv('ONCALL_OUTBOX_CLAIM_TIMEOUT', '300'))
+# Sent rows are kept this long so a late failure report can still re-enqueue them; abandoned rows, for inspection
+SENT_RETENTION = float(os.getenv('ONCALL_OUTBOX_SENT_RETENTION', '86400'))
+POLL_INTERVAL = 5.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attachment_path TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    claimed_at REAL,
+    provider_ref TEXT,
+    last_error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS outbox_ref ON outbox (provider_ref);
+"""
+
+DEFAULT_LANE = 'bulk'
+# Deliveries per second allowed to each provider; a provider not listed here is not paced
+PROVIDER_RATES = {'twilio': SEND_RATE, 'smtp': SMTP_RATE}
+
+# kind -> (handler, lane, provider)
+_handlers = dict()
+_init_lock = threading.Lock()
+_initialized_pid = None
+# The lanes whose dispatcher threads run in _dispatcher_pid
+_dispatcher_pid = None
+_dispatcher_lanes = set()
+_wakeups = {DEFAULT_LANE: threading.Event()}
+# provider -> when its last delivery was attempted, so its rate holds across batches and lanes;
+# a lock each, as a pacing sleep is taken while holding it
+_pacing_locks = {provider: threading.Lock() for provider in PROVIDER_RATES}
+_last_send = dict()
+
+def register_handler(kind, handler, lane=DEFAULT_LANE, provider=None):
+    """handler(payload, attachment_path) sends one delivery and returns a provider reference (or None).
+    lane names the dispatcher that drains the kind; provider, the PROVIDER_RATES entry pacing it."""
+    _handlers[kind] = (handler, lane, provider)
+    _wakeups.setdefault(lane, threading.Event())
+
+def ensure_running():
+    """Make sure this process has its journal and dispatcher; cheap after the first call"""
+    _ensure_initialized()
+    _ensure_dispatcher()
+
+def enqueue(kind, payload, attachment_path=None, not_before=None):
+    """Journal a delivery; attachment_path, if given, is copied into the outbox so the caller may delete it.
+    not_before (epoch seconds) holds the first attempt back until then."""
+    _ensure_initialized()
+    payload = dict(payload, _trace_id=metrics.current_trace_id())
+    stored_attachment = None
+    if attachment_path is not None:
+        stored_attachment = os.path.join(OUTBOX_DIR, '{}{}'.format(uuid.uuid4().hex, os.path.splitext(attachment_path)[1]))
+        shutil.copyfile(attachment_path, stored_attachment)
+    now = time.time()
+    with _transaction() as conn:
+        cur = conn.execute('INSERT INTO outbox (kind, payload, attachment_path, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)',
+                           (kind, json.dumps(payload), stored_attachment, max(now, not_before or now), now))
+        outbox_id = cur.lastrowid
+    logging.info('Enqueued %s delivery %d', kind, outbox_id)
+    _ensure_dispatcher()
+    _wakeups[_lane_of(kind)].set()
+    return outbox_id
+
+def requeue_by_ref(provider_ref, reason):
+    """Send again a delivery the provider reported as failed after accepting it"""
+    _ensure_initialized()
+    with _transaction() as conn:
+        row = conn.execute("SELECT id, kind, attempts FROM outbox WHERE provider_ref = ? AND status = 'sent'", (provider_ref,)).fetchone()
+        if row is None:
+            logging.warning('No sent outbox delivery with provider reference %s to re-enqueue', provider_ref)
+            return False
+        _schedule_retry(conn, row[0], row[2], reason)
+    _ensure_dispatcher()
+    _wakeups[_lane_of(row[1])].set()
+    return True
+
+def drain_once(lane=None):
+    """Claim and attempt one batch of due deliveries in lane (default: one batch in every lane);
+    returns how many were attempted"""
+    _ensure_initialized()
+    if lane is None:
+        return sum(drain_once(lane) for lane in list(_wakeups))
+    batch = _claim_batch(lane)
+    for outbox_id, kind, payload, attachment_path, attempts in batch:
+        _pace(_handlers[kind][2] if kind in _handlers else None)
+        payload = json.loads(payload)
+        metrics.set_trace_id(payload.pop('_trace_id', None))
+        _attempt(outbox_id, kind, payload, attachment_path, attempts)
+    return len(batch)
+
+def _lane_of(kind):
+    return _handlers[kind][1] if kind in _handlers else DEFAULT_LANE
+
+def _lane_filter(lane):
+    """SQL condition (and its parameters) selecting the kinds drained by lane; the default
+    lane takes every kind not assigned elsewhere, including kinds with no handler here"""
+    if lane == DEFAULT_LANE:
+        kinds = [kind for kind, (handler, kind_lane, provider) in _handlers.items() if kind_lane != DEFAULT_LANE]
+        return 'kind NOT IN ({})'.format(', '.join('?' * len(kinds))), kinds
+    kinds = [kind for kind, (handler, kind_lane, provider) in _handlers.items() if kind_lane == lane]
+    return 'kind IN ({})'.format(', '.join('?' * len(kinds))), kinds
+
+def _pace(provider):
+    """Sleep until at least 1 / rate seconds after the provider's previous delivery attempt"""
+    rate = PROVIDER_RATES.get(provider, 0)
+    if rate <= 0:
+        return
+    with _pacing_locks[provider]:
+        wait = _last_send.get(provider, 0.0) + 1.0 / rate - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        _last_send[provider] = time.monotonic()
+
+def _attempt(outbox_id, kind, payload, attachment_path, attempts):
+    try:
+        if kind not in _handlers:
+            raise LookupError('No outbox handler registered for ' + kind)
+        provider_ref = _handlers[kind][0](payload, attachment_path)
+    except Exception as e:
+        logging.exception('Outbox %s delivery %d failed (attempt %d)', kind, outbox_id, attempts + 1)
+        with _transaction() as conn:
+            _schedule_retry(conn, outbox_id, attempts + 1, repr(e))
+        return
+    with _transaction() as conn:
+        conn.execute("UPDATE outbox SET status = 'sent', attempts = ?, provider_ref = ?, claimed_at = NULL, next_attempt_at = ? WHERE id = ?",
+                     (attempts + 1, provider_ref, time.time(), outbox_id))
+    logging.info('Outbox %s delivery %d sent, provider reference %s', kind, outbox_id, provider_ref)
+
+def _schedule_retry(conn, outbox_id, attempts, reason):
+    if attempts >= MAX_ATTEMPTS:
+        # Nothing will send an abandoned delivery, so its attachment can go now
+        attachment_path = conn.execute('SELECT attachment_path FROM outbox WHERE id = ?', (outbox_id,)).fetchone()[0]
+        conn.execute("UPDATE outbox SET status = 'dead', attempts = ?, last_error = ?, claimed_at = NULL, attachment_path = NULL, next_attempt_at = ? WHERE id = ?",
+                     (attempts, reason, time.time(), outbox_id))
+        _remove_attachment(attachment_path)
+        logging.error('Outbox delivery %d abandoned after %d attempts: %s', outbox_id, attempts, reason)
+        return
+    delay = min(BACKOFF_CAP, BACKOFF_BASE * (2 ** max(attempts - 1, 0)))
+    conn.execute("UPDATE outbox SET status = 'pending', attempts = ?, last_error = ?, claimed_at = NULL, next_attempt_at = ? WHERE id = ?",
+                 (attempts, reason, time.time() + delay, outbox_id))
+    logging.info('Outbox delivery %d will be retried in %.0fs', outbox_id, delay)
+
+def _claim_batch(lane):
+    now = time.time()
+    kind_filter, kinds = _lane_filter(lane)
+    with _transaction() as conn:
+        rows = conn.execute("SELECT id, kind, payload, attachment_path, attempts FROM outbox "
+                            "WHERE ((status = 'pending' AND next_attempt_at <= ?) OR (status = 'inflight' AND claimed_at < ?)) AND " + kind_filter + " "
+                            "ORDER BY next_attempt_at LIMIT ?", [now, now - CLAIM_TIMEOUT] + kinds + [BATCH_SIZE]).fetchall()
+        conn.executemany("UPDATE outbox SET status = 'inflight', claimed_at = ? WHERE id = ?", [(now, row[0]) for row in rows])
+    return rows
+
+def _prune_finished():
+    """Delete sent and abandoned rows (finished at next_attempt_at) older than SENT_RETENTION"""
+    cutoff = time.time() - SENT_RETENTION
+    with _transaction() as conn:
+        stale = conn.execute("SELECT id, attachment_path FROM outbox WHERE status IN ('sent', 'dead') AND next_attempt_at < ?", (cutoff,)).fetchall()
+        conn.executemany('DELETE FROM outbox WHERE id = ?', [(row[0],) for row in stale])
+    for outbox_id, attachment_path in stale:
+        _remove_attachment(attachment_path)
+
+def _remove_attachment(attachment_path):
+    if attachment_path and os.path.exists(attachment_path):
+        os.unlink(attachment_path)
+
+def _next_due_in(lane):
+    kind_filter, kinds = _lane_filter(lane)
+    with _transaction() as conn:
+        row = conn.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending' AND " + kind_filter, kinds).fetchone()
+    if row[0] is None:
+        return POLL_INTERVAL
+    return min(POLL_INTERVAL, max(0.0, row[0] - time.time()))
+
+def _dispatch_forever(lane):
+    wakeup = _wakeups[lane]
+    last_prune = 0.0
+    while True:
+        try:
+            while drain_once(lane) > 0:
+                pass
+            # One lane is enough to keep the journal pruned
+            if lane == DEFAULT_LANE and time.monotonic() - last_prune > 3600:
+                _prune_finished()
+                last_prune = time.monotonic()
+            timeout = _next_due_in(lane)
+        except Exception:
+            logging.exception('Outbox %s dispatcher iteration failed', lane)
+            timeout = POLL_INTERVAL
+        wakeup.wait(timeout)
+        wakeup.clear()
+
+def _ensure_dispatcher():
+    """Start this process's dispatcher thread for each lane (once per process, so forked workers get their own)"""
+    global _dispatcher_pid
+    with _init_lock:
+        if _dispatcher_pid != os.getpid():
+            _dispatcher_pid = os.getpid()
+            _dispatcher_lanes.clear()
+        lanes = [lane for lane in _wakeups if lane not in _dispatcher_lanes]
+        _dispatcher_lanes.update(lanes)
+    for lane in lanes:
+        threading.Thread(target=_dispatch_forever, args=(lane,), name='outbox-dispatcher-' + lane, daemon=True).start()
+
+def _ensure_initialized():
+    global _initialized_pid
+    with _init_lock:
+        if _initialized_pid == os.getpid():
+            return
+        os.makedirs(OUTBOX_DIR, exist_ok=True)
+        conn = sqlite3.connect(OUTBOX_DB, timeout=30, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+        _initialized_pid = os.getpid()
+
+@contextlib.contextmanager
+def _transaction():
+    """Open a connection and run one write transaction on it. A connection per operation is
+    cheap for SQLite and keeps us clear of sharing connections across threads or forks."""
+    conn = sqlite3.connect(OUTBOX_DB, timeout=30, isolation_level=None)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
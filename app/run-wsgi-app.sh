@@ -1,3 +1,4 @@
 #!/bin/bash
 
-gunicorn --workers 1 --bind 127.0.0.1:5000 wsgi
+# Worker count and threads per worker come from gunicorn.conf.py (ONCALL_WORKERS etc.)
+exec gunicorn -c gunicorn.conf.py wsgi
@@ -0,0 +1,107 @@
+"""On-call schedule: rotations, holidays and overrides compiled into an interval index.
+
+The optional "schedule" section of the operational config looks like this (times
+are epoch seconds, like last_modified_time):
+
+    "schedule": {
+        "rotations": [
+            {"id": "weekly", "users": ["alice", "bob"], "start": 1611532800, "shift_length": 604800}
+        ],
+        "holidays": [
+            {"start": 1640390400, "end": 1640476800, "user_id": "bob"}
+        ],
+        "overrides": [
+            {"start": 1611602242, "end": 1612137600, "user_id": "alice", "reason": "take"}
+        ]
+    }
+
+Later layers win: an override beats a holiday, which beats a rotation; among
+overrides the one listed last wins, and among rotations the one listed first.
+Time not covered by any layer falls back to current_config.oncall_user.
+
+compile_schedule flattens the layers over a time window into sorted,
+non-overlapping segments, so "who is on call at t" is a binary search.
+Consecutive segments with the same user are merged, and segments are cut
+off at the window's edges, so a Shift's end is where that user's unbroken
+stretch on call ends, or the end of the window if that comes first.
+"""
+from bisect import bisect_right
+from collections import namedtuple
+
+Shift = namedtuple('Shift', ['start', 'end', 'user_id'])
+
+# How far either side of "now" a compiled schedule reaches before it must be rebuilt
+WINDOW_BEFORE = 2 * 86400
+WINDOW_AFTER = 35 * 86400
+
+class CompiledSchedule(object):
+    def __init__(self, window_start, window_end, shifts):
+        self.window_start = window_start
+        self.window_end = window_end
+        self.shifts = shifts
+        self._starts = [shift.start for shift in shifts]
+
+    def covers(self, t):
+        return self.window_start <= t < self.window_end
+
+    def shift_at(self, t):
+        """The Shift containing t, or None if no layer covers t"""
+        index = bisect_right(self._starts, t) - 1
+        if index >= 0 and t < self.shifts[index].end:
+            return self.shifts[index]
+        return None
+
+    def upcoming(self, t, count):
+        """The shift containing t (if any) followed by the next ones, up to count in total"""
+        index = max(bisect_right(self._starts, t) - 1, 0)
+        shifts = [shift for shift in self.shifts[index:index + count + 1] if shift.end > t]
+        return shifts[:count]
+
+def compile_schedule(schedule_dict, t):
+    """Compile the layers of schedule_dict over a window around t"""
+    window_start = t - WINDOW_BEFORE
+    window_end = t + WINDOW_AFTER
+    layers = []
+    for rotation in reversed(schedule_dict.get('rotations', [])):
+        layers.extend(_rotation_shifts(rotation, window_start, window_end))
+    layers.extend(_clip(schedule_dict.get('holidays', []), window_start, window_end))
+    layers.extend(_clip(schedule_dict.get('overrides', []), window_start, window_end))
+    return CompiledSchedule(window_start, window_end, _flatten(layers))
+
+def _rotation_shifts(rotation, window_start, window_end):
+    users = rotation['users']
+    start = rotation['start']
+    length = rotation['shift_length']
+    if not users or window_end <= start:
+        return []
+    first = max(0, int((window_start - start) // length))
+    shifts = []
+    n = first
+    while start + n * length < window_end:
+        shift_start = start + n * length
+        shifts.append(Shift(max(shift_start, window_start), min(shift_start + length, window_end), users[n % len(users)]))
+        n += 1
+    return shifts
+
+def _clip(entries, window_start, window_end):
+    return [Shift(max(entry['start'], window_start), min(entry['end'], window_end), entry['user_id'])
+            for entry in entries if entry['end'] > window_start and entry['start'] < window_end]
+
+def _flatten(layers):
+    """Paint the shifts in order, each over those before it, and merge neighbours with the same user"""
+    bounds = sorted(set([shift.start for shift in layers] + [shift.end for shift in layers]))
+    owners = [None] * max(len(bounds) - 1, 0)
+    for shift in layers:
+        first = bisect_right(bounds, shift.start) - 1
+        last = bisect_right(bounds, shift.end) - 1
+        for index in range(first, last):
+            owners[index] = shift.user_id
+    shifts = []
+    for index, user_id in enumerate(owners):
+        if user_id is None:
+            continue
+        if shifts and shifts[-1].user_id == user_id and shifts[-1].end == bounds[index]:
+            shifts[-1] = shifts[-1]._replace(end=bounds[index + 1])
+        else:
+            shifts.append(Shift(bounds[index], bounds[index + 1], user_id))
+    return shifts
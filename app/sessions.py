@@ -0,0 +1,155 @@
+"""Server-side SMS sessions, keyed by team and sender phone number.
+
+A session holds what one phone's text exchange needs between messages: the
+sender's user_dict, looked up once, and the active_flow awaiting a reply (TAKE
+waiting for C or X). A session lapses session_lifetime seconds after its last
+message. The lifetime is passed in on every read, so a shorter session_lifetime in the
+config applies straight away, to existing sessions as well; each session is also saved
+with the expiry its own team's lifetime gave it, and cleared out once that has passed,
+so teams with different lifetimes never cut each other's sessions short.
+Pick a store with ONCALL_SESSION_STORE:
+
+    memory   a per-process dict, least recently used entries evicted beyond
+             ONCALL_SESSION_CACHE_SIZE (default; right for a single worker)
+    sqlite   a local SQLite database at ONCALL_SESSION_DB, shared by all the
+             workers on a host, so a TAKE and its C may land on different workers
+"""
+from collections import OrderedDict
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SESSION_STORE = os.getenv('ONCALL_SESSION_STORE', 'memory')
+SESSION_DB = os.getenv('ONCALL_SESSION_DB', 'oncall-sessions.sqlite3')
+CACHE_SIZE = int(os.getenv('ONCALL_SESSION_CACHE_SIZE', '10000'))
+
+class MemorySessionStore(object):
+    kind = 'memory'
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        # team -> phone -> (saved_at, expires_at, data), oldest save first. One team's sessions
+        # share a lifetime, so within a team the earliest to expire are at the front too.
+        self._sessions = dict()
+
+    def get(self, team, phone, lifetime):
+        """The session's data, or None if there is none or it has lapsed"""
+        with self._lock:
+            entry = self._sessions.get(team, {}).get(phone)
+        if entry is None or entry[0] <= time.time() - lifetime:
+            return None
+        return dict(entry[2])
+
+    def is_active(self, phone):
+        """Whether phone has a session, with any team, that has not reached its saved expiry"""
+        now = time.time()
+        with self._lock:
+            return any(team_sessions.get(phone, (0, 0))[1] > now for team_sessions in self._sessions.values())
+
+    def save(self, team, phone, data, lifetime):
+        now = time.time()
+        with self._lock:
+            team_sessions = self._sessions.setdefault(team, OrderedDict())
+            team_sessions[phone] = (now, now + lifetime, dict(data))
+            team_sessions.move_to_end(phone)
+            for team_sessions in self._sessions.values():
+                while team_sessions and next(iter(team_sessions.values()))[1] <= now:
+                    team_sessions.popitem(last=False)
+            # Beyond capacity, evict the least recently saved session of any team
+            while sum(len(team_sessions) for team_sessions in self._sessions.values()) > self.capacity:
+                oldest = min((team_sessions for team_sessions in self._sessions.values() if team_sessions),
+                             key=lambda team_sessions: next(iter(team_sessions.values()))[0])
+                oldest.popitem(last=False)
+
+class SQLiteSessionStore(object):
+    kind = 'sqlite'
+
+    _SCHEMA = """
+    -- Superseded by sms_sessions, which records each session's expiry
+    DROP TABLE IF EXISTS sessions;
+    CREATE TABLE IF NOT EXISTS sms_sessions (
+        team TEXT NOT NULL,
+        phone TEXT NOT NULL,
+        data TEXT NOT NULL,
+        saved_at REAL NOT NULL,
+        expires_at REAL NOT NULL,
+        PRIMARY KEY (team, phone)
+    );
+    CREATE INDEX IF NOT EXISTS sms_sessions_expiry ON sms_sessions (expires_at);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._init_lock = threading.Lock()
+        self._initialized_pid = None
+
+    def get(self, team, phone, lifetime):
+        self._ensure_initialized()
+        # A lone SELECT in autocommit mode: under WAL it neither waits for nor blocks the writers
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT data FROM sms_sessions WHERE team = ? AND phone = ? AND saved_at > ?',
+                               (team, phone, time.time() - lifetime)).fetchone()
+        finally:
+            conn.close()
+        return json.loads(row[0]) if row is not None else None
+
+    def is_active(self, phone):
+        self._ensure_initialized()
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT 1 FROM sms_sessions WHERE phone = ? AND expires_at > ? LIMIT 1', (phone, time.time())).fetchone()
+        finally:
+            conn.close()
+        return row is not None
+
+    def save(self, team, phone, data, lifetime):
+        self._ensure_initialized()
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO sms_sessions (team, phone, data, saved_at, expires_at) VALUES (?, ?, ?, ?, ?)',
+                         (team, phone, json.dumps(data), now, now + lifetime))
+            conn.execute('DELETE FROM sms_sessions WHERE expires_at <= ?', (now,))
+
+    def _ensure_initialized(self):
+        with self._init_lock:
+            if self._initialized_pid == os.getpid():
+                return
+            conn = self._connect()
+            try:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.executescript(self._SCHEMA)
+            finally:
+                conn.close()
+            self._initialized_pid = os.getpid()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """One connection and write transaction per save, as in the outbox"""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+def from_env():
+    if SESSION_STORE == 'memory':
+        return MemorySessionStore(CACHE_SIZE)
+    if SESSION_STORE == 'sqlite':
+        return SQLiteSessionStore(SESSION_DB)
+    raise ValueError('Unknown ONCALL_SESSION_STORE {!r} (expected memory or sqlite)'.format(SESSION_STORE))
+
+store = from_env()
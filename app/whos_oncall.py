@@ -1,23 +1,123 @@
+from collections import OrderedDict
+import contextvars
+import copy
 import logging
 import os
+import random
+import threading
 import time
 from dotenv import load_dotenv
-import boto3
 import json
 import re
+import archive
+import config_schema
+import config_store
+import metrics
+import schedule
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
-def get_current_oncall_user():
-    config = _get_oncall_config()
-    return config['current_config']['oncall_user']
+# Teams served by this process, each with its own config object (see config_store.from_env).
+# The first is the default, used when no team has been selected.
+TEAM_IDS = [team_id.strip() for team_id in os.getenv('ONCALL_TEAMS', '').split(',') if team_id.strip()] or ['']
+_current_team = contextvars.ContextVar('oncall_team', default=TEAM_IDS[0])
+# Numbers that recently failed a lookup (mostly spam), remembered per config version
+_unknown_phone_lock = threading.Lock()
+_UNKNOWN_PHONE_CACHE_SIZE = int(os.getenv('ONCALL_UNKNOWN_PHONE_CACHE_SIZE', '4096'))
+CONFIG_WRITE_ATTEMPTS = int(os.getenv('ONCALL_CONFIG_WRITE_ATTEMPTS', '5'))
+CONFIG_WRITE_BACKOFF = float(os.getenv('ONCALL_CONFIG_WRITE_BACKOFF', '0.1'))
+
+ConfigWriteConflict = config_store.ConfigWriteConflict
+
+class _TeamConfig(object):
+    """One team's backing store and shared snapshot of its last-fetched config. Readers must
+    treat the snapshot as read-only; anything that modifies the config works on a deep copy
+    and writes it back via _set_oncall_config, which refreshes the snapshot."""
+    def __init__(self, team_id):
+        self.team_id = team_id
+        self.lock = threading.Lock()
+        # Serializes this process's writes, which would otherwise only conflict with each other
+        self.write_lock = threading.Lock()
+        self.snapshot = None
+        self.store = None
+        self.refreshing = False
+
+_teams = dict((team_id, _TeamConfig(team_id)) for team_id in TEAM_IDS)
+# Dialed number (E.164) to team id, kept up to date as each team's config is (re)loaded
+_routes_lock = threading.Lock()
+_routes = dict()
+_routes_refreshed_at = float('-inf')
+
+def use_team(team_id):
+    """Direct config reads and writes in the current context to team_id (None for the default team)"""
+    if team_id is None:
+        team_id = TEAM_IDS[0]
+    if team_id not in _teams:
+        raise LookupError('No team with id {!r}'.format(team_id))
+    _current_team.set(team_id)
+
+def get_current_team():
+    return _current_team.get()
+
+def route_dialed_number(phonenum):
+    """The id of the team whose pager_phone or from_phone is phonenum, or None. With a single
+    team every number routes to it."""
+    if len(TEAM_IDS) == 1:
+        return TEAM_IDS[0]
+    global _routes_refreshed_at
+    phonenum = normalize_phone(phonenum)
+    team_id = _routes.get(phonenum)
+    if team_id is not None:
+        return team_id
+    # A miss may mean a team's numbers changed; revalidate every team, at most once per TTL
+    with _routes_lock:
+        if time.monotonic() - _routes_refreshed_at < _config_cache_ttl():
+            return _routes.get(phonenum)
+        _routes_refreshed_at = time.monotonic()
+    for team in _teams.values():
+        try:
+            _get_team_snapshot(team)
+        except Exception:
+            logging.exception('Could not load config for team %s', team.team_id)
+    return _routes.get(phonenum)
+
+def get_current_oncall_user(at=None):
+    """Who is on call at epoch time at (default now): the schedule's answer if it has one, else current_config.oncall_user"""
+    snapshot = _get_oncall_snapshot()
+    shift = _get_shift_at(snapshot, time.time() if at is None else at)
+    if shift is not None:
+        return snapshot['config']['available_users']['users'][shift.user_id]
+    return snapshot['config']['current_config']['oncall_user']
+
+def get_current_oncall_shift(at=None):
+    """The scheduled Shift covering epoch time at (default now), or None when the schedule leaves it to oncall_user"""
+    return _get_shift_at(_get_oncall_snapshot(), time.time() if at is None else at)
+
+def get_upcoming_oncall_shifts(count, at=None):
+    """Up to count scheduled Shifts, starting with the one covering epoch time at (default now)"""
+    at = time.time() if at is None else at
+    return _get_compiled_schedule(_get_oncall_snapshot(), at).upcoming(at, count)
 
 def set_current_oncall_user(user_id, actor_id):
-    config = _get_oncall_config()
-    assert user_id in config['available_users']['users']
-    config['current_config']['oncall_user'] = config['available_users']['users'][user_id]
-    _set_oncall_config(config, actor_id)
+    """Put user_id on call. With a schedule, this is an override lasting until the shift it
+    replaces would have ended; oncall_user is updated too, for when no shift applies.
+    The replaced shift is taken from the compiled schedule, so it runs to the end of its user's
+    unbroken stretch on call, but no further than schedule.WINDOW_AFTER from now."""
+    def make_oncall(config):
+        if user_id not in config['available_users']['users']:
+            raise ValueError('No available user with id ' + user_id)
+        config['current_config']['oncall_user'] = config['available_users']['users'][user_id]
+        schedule_dict = config.get('schedule')
+        if schedule_dict is None:
+            return
+        now = int(time.time())
+        replaced_shift = schedule.compile_schedule(schedule_dict, now).shift_at(now)
+        overrides = [override for override in schedule_dict.get('overrides', []) if override['end'] > now]
+        if replaced_shift is not None:
+            overrides.append({'start': now, 'end': replaced_shift.end, 'user_id': user_id, 'reason': 'take', 'actor_id': actor_id})
+        schedule_dict['overrides'] = overrides
+    _update_oncall_config(make_oncall, actor_id)
 
 def get_current_pager_phone():
     config = _get_oncall_config()
@@ -35,6 +135,10 @@ def get_current_to_email():
     config = _get_oncall_config()
     return config['current_config']['mail_settings']['to_email']
 
+def get_current_mail_settings():
+    config = _get_oncall_config()
+    return config['current_config']['mail_settings']
+
 def get_current_mail_password():
     config = _get_oncall_config()
     return config['current_config']['mail_settings']['mail_password']
@@ -63,6 +167,11 @@ def get_available_oncall_users():
     config = _get_oncall_config()
     return config['available_users']['users']
 
+def get_escalation_tiers():
+    """The configured escalation tiers (each with user_ids and after, in seconds); empty if escalation is off"""
+    config = _get_oncall_config()
+    return config.get('escalation', {}).get('tiers', [])
+
 def get_oncall_config_last_modified_time():
     config = _get_oncall_config()
     return config['current_config']['last_modified_time']
@@ -72,78 +181,195 @@ def get_oncall_config_last_modified_user_id():
     return config['current_config']['last_modified_user_id']
 
 def lookup_user_by_phone(phonenum):
-    config = _get_oncall_config()
-    for user_id, user_dict in config['available_users']['users'].items():
-        if phonenum == user_dict['phone']:
-            return user_dict
-    return None
-
-def _validate_oncall_config(config_dict):
-    assert 'current_config' in config_dict, 'Top-level current_config not present'
-    assert 'oncall_user' in config_dict['current_config'], 'current_config.oncall_user not present'
-    assert _validate_user(config_dict['current_config']['oncall_user']), 'current_config.oncall_user fails validation'
-    assert _validate_top_contact_items(config_dict['current_config']), 'current_config contact items fail validation'
-    assert 'last_modified_time' in config_dict['current_config'], 'current_config.last_modified_time not present'
-    assert 'last_modified_user_id' in config_dict['current_config'], 'current_config.last_modified_user_id not present'
-    assert 'available_users' in config_dict, 'Top-level available_users not present'
-    assert 'users' in config_dict['available_users'], 'available_users.users not present'
-    for user_id, user_dict in config_dict['available_users']['users'].items():
-        assert _validate_user(user_dict), 'available_users item ' + user_id + ' failed validation'
-    assert _validate_available_users_unique(config_dict['available_users']), 'available_users failed uniqueness check'
-    assert _validate_mail_settings(config_dict['current_config']['mail_settings']), 'current_config.mail_settings failed validation'
-    assert 'session_lifetime' in config_dict['current_config'], 'current_config.session_lifetime not present'
-    return True
-
-def _validate_top_contact_items(current_config):
-    assert 'pager_phone' in current_config, 'current_config lacks pager_phone'
-    assert re.fullmatch(r"^\+1[2-9][0-9]{2}[2-9][0-9]{6}$", current_config['pager_phone']), 'current_config pager_phone ' + current_config['pager_phone'] + ' failed validation'
-    assert 'from_phone' in current_config, 'current_config lacks from_phone'
-    assert re.fullmatch(r"^\+1[2-9][0-9]{2}[2-9][0-9]{6}$", current_config['from_phone']), 'current_config from_phone ' + current_config['from_phone'] + ' failed validation'
-    return True
-
-def _validate_available_users_unique(available_users_dict):
-    phone_dedup = dict()
-    name_dedup = dict()
-    for user_id, user_dict in available_users_dict['users'].items():
-        assert user_dict['id'] == user_id, 'Available user record outer ID ' + user_id + ' mismatched with inner id ' + user_dict['id']
-        assert user_dict['phone'] not in phone_dedup, 'Phone ' + user_dict['phone'] + ' is not unique among available users'
-        phone_dedup[user_dict['phone']] = user_dict['phone']
-        assert user_dict['name'] not in name_dedup, 'Name ' + user_dict['name'] + ' is not unique among available users'.format(user_dict['phone'])
-        name_dedup[user_dict['name']] = user_dict['name']
-    return True
-
-def _validate_user(user_dict):
-    assert 'id' in user_dict, 'User id not present'
-    assert 'name' in user_dict, 'User name not present'
-    assert 'phone' in user_dict, 'User phone not present'
-    assert re.fullmatch(r"^\+1[2-9][0-9]{2}[2-9][0-9]{6}$", user_dict['phone']), 'User phone ' + user_dict['phone'] + ' failed validation'
-    return True
-
-def _validate_mail_settings(mail_settings):
-    assert 'from_email' in mail_settings, 'current_config.mail_settings lacks from_email'
-    assert re.fullmatch(r"\S+@\S+\.\S+", mail_settings['from_email']), 'current_config.mail_settings from_email ' + mail_settings['from_email'] + ' failed validation'
-    assert 'mail_password' in mail_settings, 'current_config.mail_settings lacks mail_password'
-    assert 'mail_port' in mail_settings, 'current_config.mail_settings lacks mail_port'
-    assert 'mail_server' in mail_settings, 'current_config.mail_settings lacks mail_server'
-    assert 'mail_use_tls' in mail_settings, 'current_config.mail_settings lacks mail_use_tls'
-    assert 'mail_username' in mail_settings, 'current_config.mail_settings lacks mail_user'
-    assert 'to_email' in mail_settings, 'current_config.mail_settings lacks to_email'
-    assert re.fullmatch(r"\S+@\S+\.\S+", mail_settings['to_email']), 'current_config.mail_settings to_email ' + mail_settings['to_email'] + ' failed validation'
-    return True
+    snapshot = _get_oncall_snapshot()
+    unknown_phones = snapshot['unknown_phones']
+    if phonenum in unknown_phones:
+        return None
+    user_dict = snapshot['phone_index'].get(normalize_phone(phonenum))
+    if user_dict is None:
+        with _unknown_phone_lock:
+            unknown_phones[phonenum] = True
+            if len(unknown_phones) > _UNKNOWN_PHONE_CACHE_SIZE:
+                unknown_phones.popitem(last=False)
+    return user_dict
+
+def normalize_phone(phonenum):
+    """Reduce a phone number to E.164, assuming NANP for bare 10- or 11-digit numbers"""
+    if phonenum is None:
+        return ''
+    digits = re.sub(r'[^0-9]', '', phonenum)
+    if phonenum.strip().startswith('+'):
+        return '+' + digits
+    if len(digits) == 10:
+        return '+1' + digits
+    if len(digits) == 11 and digits.startswith('1'):
+        return '+' + digits
+    return digits
+
+def _update_oncall_config(mutate, actor_id):
+    """Apply mutate to a copy of the current config and write it back only if nobody else
+    has written since it was read, re-reading and retrying with backoff on conflict"""
+    with _teams[_current_team.get()].write_lock:
+        return _update_oncall_config_locked(mutate, actor_id)
+
+def _update_oncall_config_locked(mutate, actor_id):
+    team = _teams[_current_team.get()]
+    for attempt in range(CONFIG_WRITE_ATTEMPTS):
+        # A retry must see what won the conflict, not the shared snapshot another thread may be refreshing
+        snapshot = _get_team_snapshot(team) if attempt == 0 else _reload_team_snapshot(team)
+        config = copy.deepcopy(snapshot['config'])
+        mutate(config)
+        try:
+            return _set_oncall_config(config, actor_id, if_match=snapshot['etag'])
+        except ConfigWriteConflict:
+            if attempt + 1 == CONFIG_WRITE_ATTEMPTS:
+                break
+            delay = CONFIG_WRITE_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.0)
+            logging.warning('Config changed since ETag %s was read (attempt %d of %d), retrying in %.2fs', snapshot['etag'], attempt + 1, CONFIG_WRITE_ATTEMPTS, delay)
+            time.sleep(delay)
+    raise ConfigWriteConflict('Gave up writing config after {} conflicting attempts'.format(CONFIG_WRITE_ATTEMPTS))
+
+def _expire_oncall_snapshot(team=None):
+    """Force the next read to revalidate against the backing store without discarding the cached copy"""
+    team = team or _teams[_current_team.get()]
+    with team.lock:
+        if team.snapshot is not None:
+            team.snapshot['checked_at'] = float('-inf')
+
+def _config_cache_ttl():
+    return float(os.getenv('ONCALL_CONFIG_CACHE_TTL', '15'))
 
 def _get_oncall_config():
-    s3c = boto3.client('s3')
-    config_obj = s3c.get_object(Bucket=os.getenv('BACKING_STORE_S3_BUCKET'), Key=os.getenv('BACKING_STORE_S3_KEY'))
-    config_dict = json.loads(config_obj['Body'].read())
-    if _validate_oncall_config(config_dict):
-        return config_dict
-    else:
-        return {}
-
-def _set_oncall_config(config_dict, actor_id):
+    return _get_oncall_snapshot()['config']
+
+def _get_config_store(team):
+    if team.store is None:
+        team.store = config_store.from_env(team.team_id)
+    # Change notifications expire the snapshot at once instead of waiting out the TTL
+    team.store.watch(lambda: _expire_oncall_snapshot(team))
+    return team.store
+
+def _get_oncall_snapshot():
+    return _get_team_snapshot(_teams[_current_team.get()])
+
+def _get_team_snapshot(team):
+    """Return the team's config snapshot, revalidating it against the backing store once its TTL lapses.
+    One thread revalidates while the others carry on with the snapshot they have, so a slow
+    backing store holds up a single request rather than every request in flight. If revalidation
+    fails (store unreachable, or the new version invalid), the snapshot in hand is kept for another TTL."""
+    with team.lock:
+        snapshot = team.snapshot
+        now = time.monotonic()
+        if snapshot is not None and (now - snapshot['checked_at'] < _config_cache_ttl() or team.refreshing):
+            return snapshot
+        team.refreshing = True
+        store = _get_config_store(team)
+    try:
+        try:
+            fetched = _fetch_team_snapshot(team, store, snapshot, now)
+        except Exception:
+            if snapshot is None:
+                raise
+            logging.exception('Could not revalidate config for team %r, serving version %s', team.team_id, snapshot['etag'])
+            snapshot['checked_at'] = now
+            return snapshot
+        return _install_team_snapshot(team, snapshot, fetched)
+    finally:
+        with team.lock:
+            team.refreshing = False
+
+def _reload_team_snapshot(team):
+    """Revalidate the team's config right now, whatever its TTL and whether or not another
+    thread is refreshing it; errors are raised, not papered over with the snapshot in hand"""
+    with team.lock:
+        snapshot = team.snapshot
+        store = _get_config_store(team)
+    return _install_team_snapshot(team, snapshot, _fetch_team_snapshot(team, store, snapshot, time.monotonic()))
+
+def _fetch_team_snapshot(team, store, snapshot, now):
+    """A conditional GET against snapshot's version: snapshot itself if unchanged, else a new one"""
+    with metrics.timed(store.kind + '.get_config'):
+        result = store.get(if_none_match=snapshot['etag'] if snapshot is not None else None)
+    if result is config_store.NOT_MODIFIED:
+        snapshot['checked_at'] = now
+        return snapshot
+    raw_config, version = result
+    config_dict = json.loads(raw_config)
+    config_schema.check(config_dict, config_schema.content_hash(raw_config))
+    logging.debug('Fetched config version %s for team %r', version, team.team_id)
+    return _make_snapshot(team, config_dict, version, now)
+
+def _install_team_snapshot(team, snapshot, fetched):
+    with team.lock:
+        # A write may have installed a newer snapshot while this read was in flight
+        if team.snapshot is snapshot:
+            team.snapshot = fetched
+            return fetched
+        return team.snapshot
+
+def _make_snapshot(team, config_dict, etag, checked_at):
+    phone_index = dict()
+    for user_id, user_dict in config_dict.get('available_users', {}).get('users', {}).items():
+        phone_index[normalize_phone(user_dict['phone'])] = user_dict
+    _index_team_routes(team.team_id, config_dict)
+    return {'config': config_dict, 'etag': etag, 'checked_at': checked_at, 'phone_index': phone_index, 'unknown_phones': OrderedDict(), 'schedule': None}
+
+def _index_team_routes(team_id, config_dict):
+    numbers = set(normalize_phone(config_dict['current_config'][key]) for key in ('pager_phone', 'from_phone'))
+    with _routes_lock:
+        for number in [number for number, routed_team_id in _routes.items() if routed_team_id == team_id and number not in numbers]:
+            del _routes[number]
+        for number in numbers:
+            if _routes.setdefault(number, team_id) != team_id:
+                logging.error('Team %s uses %s, which already routes to team %s', team_id, number, _routes[number])
+
+def _get_shift_at(snapshot, at):
+    if 'schedule' not in snapshot['config']:
+        return None
+    return _get_compiled_schedule(snapshot, at).shift_at(at)
+
+def _get_compiled_schedule(snapshot, at):
+    """The snapshot's schedule compiled over a window around at, rebuilt only when at falls outside it"""
+    compiled = snapshot['schedule']
+    if compiled is None or not compiled.covers(at):
+        compiled = schedule.compile_schedule(snapshot['config'].get('schedule', {}), at)
+        snapshot['schedule'] = compiled
+    return compiled
+
+def _set_oncall_config(config_dict, actor_id, if_match=None):
+    """Write the config; with if_match, only if the stored version still matches (else ConfigWriteConflict)"""
+    team = _teams[_current_team.get()]
     config_dict['current_config']['last_modified_time'] = int(time.time())
     config_dict['current_config']['last_modified_user_id'] = actor_id
-    assert _validate_oncall_config(config_dict)
-    s3c = boto3.client('s3')
-    s3c.put_object(Bucket=os.getenv('BACKING_STORE_S3_BUCKET'), Key=os.getenv('BACKING_STORE_S3_KEY'), Body=json.dumps(config_dict, sort_keys=True, indent=4))
+    raw_config = json.dumps(config_dict, sort_keys=True, indent=4).encode('utf-8')
+    config_schema.check(config_dict, config_schema.content_hash(raw_config))
+    with team.lock:
+        previous_config = team.snapshot['config'] if team.snapshot is not None else None
+        store = _get_config_store(team)
+    # Readers keep using the current snapshot while the write is in flight
+    with metrics.timed(store.kind + '.put_config'):
+        version = store.put(raw_config, if_match=if_match)
+    with team.lock:
+        team.snapshot = _make_snapshot(team, config_dict, version, time.monotonic())
+    try:
+        archive.record_config_change(team.team_id, {
+                    'time': config_dict['current_config']['last_modified_time'],
+                    'actor_id': actor_id,
+                    'version': version,
+                    'changed': _changed_sections(previous_config, config_dict),
+                    'oncall_user_id': config_dict['current_config']['oncall_user']['id'],
+                })
+    except Exception:
+        logging.exception('Config version %s was written but could not be added to the audit trail', version)
     return config_dict
+
+def _changed_sections(old_config, new_config):
+    """Dotted names of the top-level and current_config sections that differ, bookkeeping aside"""
+    if old_config is None:
+        return sorted(new_config)
+    changed = [key for key in set(old_config) | set(new_config) if key != 'current_config' and old_config.get(key) != new_config.get(key)]
+    old_current = old_config.get('current_config', {})
+    new_current = new_config.get('current_config', {})
+    changed += ['current_config.' + key for key in set(old_current) | set(new_current)
+                if not key.startswith('last_modified_') and old_current.get(key) != new_current.get(key)]
+    return sorted(changed)
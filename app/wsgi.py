@@ -1,4 +1,5 @@
+# Importing the app fetches nothing from S3; the operational config is loaded on the first webhook
 from oncall import app as application
 
 if __name__ == "__main__":
-    app.run()
+    application.run()